@@ -1,10 +1,20 @@
 import json
 import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
 
 from butler import Butler
 from butler.visualize import *
 from downloader import *
-from settings import ROOT_DIR
+from settings import ROOT_DIR, COLLECTOR_SETTINGS, DOWNLOADER_SETTINGS
+
+if DOWNLOADER_SETTINGS.get('backend') == 'CCCAGG_ASYNC':
+    raise ValueError("The scripts of app.py need a blocking downloader, set DOWNLOADER_SETTINGS['backend'] "
+                     "to 'CCCAGG' and drive downloader.AsyncDownloader from an event loop of your own instead")
 
 butler = Butler()
 downloader = Downloader()
@@ -30,39 +40,251 @@ def get_watchlist(from_cache=True):
     return watchlist
 
 
-def collect(base, counter):
-    base = base.upper()
-    counter = counter.upper()
+def fetch(base, counter):
+    """Download the candlesticks of a pair newer than the latest one in the database"""
     ts = butler.latest_timestamp(base, counter)
     if ts is None:
         ts = datetime(2017, 2, 1, 0, 0).timestamp()
-    data = downloader.get_candlesticks(base, counter, start=ts)
+    return downloader.get_candlesticks(base, counter, start=ts, columnar=True)
+
+
+def store(base, counter, data):
+    """Save downloaded candlesticks of a pair and update its indicators and longer timeframes"""
     if len(data):
         butler.save_candlesticks(data)
     butler.update_indicators(base, counter)
+    if COLLECTOR_SETTINGS.get('timeframes'):
+        butler.update_timeframes(base, counter, COLLECTOR_SETTINGS['timeframes'])
 
 
-def single_run():
+def collect(base, counter):
+    base = base.upper()
+    counter = counter.upper()
+    store(base, counter, fetch(base, counter))
+
+
+def watchlist_pairs():
     watchlist = get_watchlist(from_cache=True)
+    pairs = []
     for counter in main_coins:
         for base in watchlist:
             counter = counter.upper()
             base = base.upper()
             if base == counter:
                 continue
-            collect(base, counter)
+            pairs.append((base, counter))
+    return pairs
+
+
+def single_run():
+    for base, counter in watchlist_pairs():
+        collect(base, counter)
+
+
+def concurrent_run(concurrency=None):
+    """Same as `single_run`, except that the downloads of several pairs overlap. Requests of all
+    the download threads share the rate limit configured in `DOWNLOADER_SETTINGS`, while a
+    single worker thread saves the downloaded data and updates indicators pair by pair as
+    downloads complete
+
+    :param concurrency: number of pairs downloaded at the same time, defaults to
+        `COLLECTOR_SETTINGS['concurrency']`
+    :return: dict of the failed pairs, as "BASE/COUNTER", and their error messages
+    """
+    concurrency = concurrency or COLLECTOR_SETTINGS['concurrency']
+    pairs = watchlist_pairs()
+    downloader.sync_rate_limit()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        failures, _ = collect_pairs(pairs, fetch, pool)
+
+    print("Collection complete, {} of {} pairs succeeded.".format(len(pairs) - len(failures), len(pairs)))
+    for pair, error in sorted(failures.items()):
+        sys.stderr.write("{}: {}\n".format(pair, error))
+    return failures
+
+
+def collect_pairs(pairs, fetch_pair, pool):
+    """Download pairs on a thread pool while a single worker thread saves each download and
+    updates its indicators as soon as it completes
+
+    :param pairs: list of (base, counter) tuples
+    :param fetch_pair: function downloading the candlesticks of a pair, e.g. `fetch`
+    :param pool: the `ThreadPoolExecutor` running the downloads
+    :return: tuple of the dict of the failed pairs, as "BASE/COUNTER", and their error messages,
+        and the dict of the downloaded candlesticks keyed by (base, counter)
+    """
+    failures = {}
+    downloaded = {}
+    queue = Queue()
+
+    def write():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            base, counter, data = item
+            try:
+                store(base, counter, data)
+                downloaded[(base, counter)] = data
+            except Exception as e:
+                failures["{}/{}".format(base, counter)] = "saving failed: {}".format(e)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    futures = {pool.submit(fetch_pair, base, counter): (base, counter) for base, counter in pairs}
+    for future in as_completed(futures):
+        base, counter = futures[future]
+        try:
+            queue.put((base, counter, future.result()))
+        except Exception as e:
+            failures["{}/{}".format(base, counter)] = "download failed: {}".format(e)
+    queue.put(None)
+    writer.join()
+    return failures, downloaded
+
+
+# latency stats of the latest cycles of `run_forever`, the oldest first
+cycle_stats = deque(maxlen=COLLECTOR_SETTINGS.get('stats_history', 168))
+
+
+def run_forever(concurrency=None, delay=None, cycles=None):
+    """Collect the candlesticks of the watchlist pairs every hour as a long-running service.
+    The collector wakes `delay` seconds after each hour closes and downloads only the hours
+    closed since the latest candlestick known for each pair, usually just the last one. The
+    downloads of all the pairs share one thread pool and the module's database and HTTP
+    connection pools, which all stay warm between cycles, and indicators are updated
+    incrementally. The latency stats of every cycle are printed and kept in `cycle_stats`
+
+    :param concurrency: number of pairs downloaded at the same time, defaults to
+        `COLLECTOR_SETTINGS['concurrency']`
+    :param delay: seconds to wait after the hour before downloading, defaults to
+        `COLLECTOR_SETTINGS['delay']`
+    :param cycles: number of cycles to run, None to run until interrupted
+    :return: None
+    """
+    concurrency = concurrency or COLLECTOR_SETTINGS['concurrency']
+    delay = COLLECTOR_SETTINGS.get('delay', 5) if delay is None else delay
+    # latest candlestick of each pair, read from the database once and then tracked here
+    latest = {}
+    last_hour = None
+
+    def fetch_closed(base, counter):
+        if (base, counter) not in latest:
+            latest[(base, counter)] = butler.latest_timestamp(base, counter)
+        ts = latest[(base, counter)]
+        if ts is None:
+            return fetch(base, counter)
+        first, last = ts + 3600, hour - 3600
+        return downloader.get_missing(base, counter, [(first, last)] if first <= last else [], columnar=True)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        try:
+            while cycles is None or cycles > 0:
+                hour = int(time.time()) // 3600 * 3600
+                if hour == last_hour:
+                    hour += 3600
+                time.sleep(max(hour + delay - time.time(), 0))
+                start = time.time()
+                pairs = watchlist_pairs()
+                downloader.sync_rate_limit()
+                failures, downloaded = collect_pairs(pairs, fetch_closed, pool)
+                for (base, counter), data in downloaded.items():
+                    if len(data):
+                        latest[(base, counter)] = int(data['timestamp'].max())
+                end = time.time()
+
+                stats = {
+                    'hour': hour,
+                    'wake_lag': start - hour,
+                    'duration': end - start,
+                    'freshness_lag': end - hour,
+                    'pairs': len(pairs),
+                    'failed': len(failures),
+                    'candles': sum(len(data) for data in downloaded.values()),
+                    'stale': sum(latest.get(pair) != hour - 3600 for pair in pairs)
+                }
+                cycle_stats.append(stats)
+                print("Cycle {}: {candles} candlesticks of {pairs} pairs in {duration:.1f}s, "
+                      "woke {wake_lag:.1f}s and done {freshness_lag:.1f}s after the hour, "
+                      "{failed} failed, {stale} not up to date".format(datetime.fromtimestamp(hour), **stats))
+                for pair, error in sorted(failures.items()):
+                    sys.stderr.write("{}: {}\n".format(pair, error))
+                last_hour = hour
+                if cycles is not None:
+                    cycles -= 1
+        except KeyboardInterrupt:
+            print("Collector stopped.")
+
+
+def repair(pairs=None):
+    """Download the hours missing in the middle of the stored series and recalculate the
+    indicators of the repaired pairs. Gaps are found by a single integrity scan over all the
+    pairs, and each pair's gaps are fetched with as few requests as their sizes allow
+
+    :param pairs: list of (base, counter) tuples to repair, defaults to every pair in the database
+    :return: dict of the number of candlesticks added keyed by pair, as "BASE/COUNTER"; pairs
+        whose download failed are left out and reported at the end
+    """
+    reports = butler.integrity_reports()
+    if pairs is not None:
+        selected = {(base.upper(), counter.upper()) for base, counter in pairs}
+        reports = [r for r in reports if tuple(r['pair']) in selected]
+    added = {}
+    failures = {}
+    for report in reports:
+        base, counter = report['pair']
+        if not report['gaps'] and not report['missing_indicators']:
+            continue
+        if report['gaps']:
+            try:
+                data = downloader.get_missing(base, counter, report['gaps'], columnar=True)
+            except Exception as e:
+                failures["{}/{}".format(base, counter)] = "download failed: {}".format(e)
+                continue
+            added["{}/{}".format(base, counter)] = butler.save_candlesticks(data) if len(data) else 0
+        # candlesticks inserted in the past change the EMAs of every later one, which are all
+        # rewritten along with the spans missing their indicators
+        since = min([gap[0] for gap in report['gaps']] + [span[0] for span in report['missing_indicators']])
+        butler.update_indicators(base, counter, since=since)
+        if COLLECTOR_SETTINGS.get('timeframes'):
+            butler.update_timeframes(base, counter, COLLECTOR_SETTINGS['timeframes'], incremental=False)
+    print("Repair complete, {} candlesticks added to {} pairs, {} pairs failed.".format(
+        sum(added.values()), len(added), len(failures)
+    ))
+    for pair, error in sorted(failures.items()):
+        sys.stderr.write("{}: {}\n".format(pair, error))
+    return added
 
 
 def prepare_train_data(path):
     train_end = datetime(2018, 6, 1, 23, 59).timestamp()
     valid_end = datetime(2018, 6, 10, 23, 59).timestamp()
     test_end = datetime.now().timestamp()
-    butler.generate_train_files(path, 'train', end=train_end)
-    butler.generate_train_files(path, 'valid', start=train_end + 1, end=valid_end)
-    butler.generate_train_files(path, 'test', start=valid_end + 1, end=test_end)
+    butler.generate_split_files(path, [
+        ('train', None, train_end),
+        ('valid', train_end + 1, valid_end),
+        ('test', valid_end + 1, test_end)
+    ])
+
+
+def refresh_train_data(path):
+    """Append the windows of the candlesticks collected since the last refresh to the sharded
+    dataset in `path`, creating it on the first run
+    """
+    train_end = datetime(2018, 6, 1, 23, 59).timestamp()
+    valid_end = datetime(2018, 6, 10, 23, 59).timestamp()
+    butler.generate_shards(path, [
+        ('train', None, train_end),
+        ('valid', train_end + 1, valid_end),
+        ('test', valid_end + 1, None)
+    ], incremental=True)
 
 
 if __name__ == '__main__':
     # get_watchlist(False)
     # single_run()
+    # concurrent_run()
+    # run_forever()
+    # repair()
+    # refresh_train_data('data/shards/')
     prepare_train_data('data/')
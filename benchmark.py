@@ -0,0 +1,101 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from butler.indicators import macd_components, sma
+from butler.storage import open_storage
+from candles import Candles
+from settings import DATABASE_SETTINGS
+
+START = 1514764800
+
+
+def synthetic_candles(base, counter, hours, start=START, seed=0):
+    """Random walk hourly candlesticks of a pair"""
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, .01, hours)))
+    open = np.concatenate([[100], close[:-1]])
+    return Candles.from_columns(
+        base, counter,
+        timestamp=start + 3600 * np.arange(hours),
+        open=open, close=close,
+        high=np.maximum(open, close) * 1.005, low=np.minimum(open, close) * .995,
+        volume=rng.uniform(0, 1000, hours)
+    )
+
+
+def timed(timings, name, func, *args, **kwargs):
+    begin = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[name] = timings.get(name, 0) + time.perf_counter() - begin
+    return result
+
+
+def run(storage, pairs=10, hours=20000, appends=24):
+    """Run the same workload against a storage engine: a bulk load of the history of every
+    pair, the indicators written back, then hours appended one at a time as the collector
+    does, and the reads of a training export
+
+    :return: dict of seconds spent keyed by operation
+    """
+    timings = {}
+    history = [synthetic_candles('C{}'.format(i), 'USDT', hours + appends, seed=i) for i in range(pairs)]
+    for candles in history:
+        timed(timings, 'bulk save', storage.save, candles[:hours])
+    for candles in history:
+        stored = timed(timings, 'full read', storage.read, candles.base, candles.counter, fields=['timestamp', 'close'])
+        close = stored['close']
+        fast, slow, signal = macd_components(close)
+        timed(
+            timings, 'indicator update', storage.update, candles.base, candles.counter, stored['timestamp'],
+            ma1=sma(close, 6), ma2=sma(close, 12), ma3=sma(close, 24),
+            macd_proper=fast - slow, macd_signal=signal, macd_diff=fast - slow - signal
+        )
+    for hour in range(hours, hours + appends):
+        for candles in history:
+            timed(timings, 'latest timestamp', storage.latest_timestamp, candles.base, candles.counter)
+            timed(timings, 'append hour', storage.save, candles[hour:hour + 1])
+    for candles in history:
+        timed(timings, 'full read', storage.read, candles.base, candles.counter)
+        timed(timings, 'range read', storage.read, candles.base, candles.counter,
+              START + 3600 * hours // 2, START + 3600 * (hours // 2 + 1000))
+    stored = sum(len(storage.read(c.base, c.counter, fields=['timestamp'])) for c in history)
+    assert stored == pairs * (hours + appends), "{} of {} candlesticks stored".format(stored, pairs * (hours + appends))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the storage engines on the same workload")
+    parser.add_argument('engines', nargs='*', default=['sqlite', 'file'],
+                        help="engines to compare, 'mysql' uses the server of settings.DATABASE_SETTINGS")
+    parser.add_argument('--pairs', type=int, default=10)
+    parser.add_argument('--hours', type=int, default=20000)
+    parser.add_argument('--appends', type=int, default=24)
+    args = parser.parse_args()
+
+    results = {}
+    for engine in args.engines:
+        directory = tempfile.mkdtemp()
+        configs = dict(DATABASE_SETTINGS, engine=engine)
+        if engine == 'sqlite':
+            configs['path'] = os.path.join(directory, 'benchmark.sqlite')
+        elif engine == 'file':
+            configs['path'] = directory
+        print("Benchmarking the {} engine...".format(engine))
+        try:
+            results[engine] = run(open_storage(configs), args.pairs, args.hours, args.appends)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    operations = list(next(iter(results.values())))
+    print("\n{:<20}".format('seconds') + "".join("{:>12}".format(e) for e in results))
+    for operation in operations:
+        print("{:<20}".format(operation) + "".join("{:>12.3f}".format(t[operation]) for t in results.values()))
+
+
+if __name__ == '__main__':
+    main()
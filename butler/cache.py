@@ -0,0 +1,150 @@
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+
+from candles import Candles, DTYPE, FIELDS
+from settings import ensure_dir_exists
+
+
+class CandleCache(object):
+    """Local copy of the candlesticks of each pair, one raw binary file per column plus a small
+    JSON file holding the number of rows and the time range. Since candlesticks are appended
+    hour after hour, new rows are appended to the column files and indicator updates are
+    written in place; any other change invalidates the pair, which is then filled again from
+    the database on the next read
+
+    The row count in the JSON file is written last and is the only one trusted, so rows of an
+    interrupted append are ignored and overwritten by the next one
+    """
+    def __init__(self, root):
+        """
+        :param root: directory of the cache, e.g. `settings.CACHE_ROOT`
+        """
+        self.root = os.path.join(root, 'candles')
+
+    def path(self, base, counter):
+        return os.path.join(self.root, re.sub(r'[^0-9A-Za-z]', '_', '{}-{}'.format(base, counter)))
+
+    def meta(self, base, counter):
+        """Row count and time range of a cached pair, None when the pair is not cached"""
+        meta_path = os.path.join(self.path(base, counter), 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        return json.load(open(meta_path, 'r'))
+
+    def _write_meta(self, base, counter, count, first, last):
+        path = self.path(base, counter)
+        meta = {'pair': [base, counter], 'count': count, 'first': first, 'last': last}
+        tmp = os.path.join(path, 'meta.json.tmp')
+        json.dump(meta, open(tmp, 'w'))
+        os.replace(tmp, os.path.join(path, 'meta.json'))
+
+    def _column(self, base, counter, field, count, mode='r'):
+        return np.memmap(
+            os.path.join(self.path(base, counter), field + '.bin'),
+            dtype=DTYPE[field], mode=mode, shape=(count, )
+        )
+
+    def load(self, base, counter, start=None, end=None, fields=None):
+        """Read the cached candlesticks of a pair between two timestamps
+
+        :return: a `Candles` holding the requested fields, None when the pair is not cached
+        """
+        meta = self.meta(base, counter)
+        if meta is None:
+            return None
+        count = meta['count']
+        if not count:
+            return Candles.empty(base, counter)
+        timestamps = self._column(base, counter, 'timestamp', count)
+        lo = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+        hi = count if end is None else int(np.searchsorted(timestamps, end, side='right'))
+        columns = {
+            f: np.array(self._column(base, counter, f, count)[lo:hi])
+            for f in fields or FIELDS
+        }
+        return Candles.from_columns(base, counter, **columns)
+
+    def store(self, candles):
+        """Replace the cached candlesticks of a pair"""
+        self.invalidate(candles.base, candles.counter)
+        ensure_dir_exists(self.path(candles.base, candles.counter))
+        for field in FIELDS:
+            open(os.path.join(self.path(candles.base, candles.counter), field + '.bin'), 'wb').close()
+        self._write_meta(candles.base, candles.counter, 0, None, None)
+        self.append(candles)
+
+    def append(self, candles):
+        """Append candlesticks newer than the cached ones, invalidating the pair otherwise
+
+        :return: True if appended
+        """
+        base, counter = candles.base, candles.counter
+        meta = self.meta(base, counter)
+        if meta is None:
+            return False
+        if not len(candles):
+            return True
+        timestamps = candles['timestamp']
+        if meta['last'] is not None and timestamps[0] <= meta['last'] or np.any(np.diff(timestamps) <= 0):
+            self.invalidate(base, counter)
+            return False
+        for field in FIELDS:
+            with open(os.path.join(self.path(base, counter), field + '.bin'), 'r+b') as f:
+                f.truncate(meta['count'] * DTYPE[field].itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(np.ascontiguousarray(candles[field]).tobytes())
+        first = meta['first'] if meta['first'] is not None else int(timestamps[0])
+        self._write_meta(base, counter, meta['count'] + len(candles), first, int(timestamps[-1]))
+        return True
+
+    def update(self, base, counter, timestamps, **columns):
+        """Overwrite some columns of cached candlesticks in place, the pair is invalidated when
+        any of the timestamps is not cached
+
+        :param timestamps: timestamps of the candlesticks to update
+        :param columns: new values of the columns keyed by field name
+        :return: True if updated
+        """
+        meta = self.meta(base, counter)
+        if meta is None:
+            return False
+        if not len(timestamps):
+            return True
+        positions = self.positions(base, counter, timestamps)
+        if positions is None:
+            self.invalidate(base, counter)
+            return False
+        for field, values in columns.items():
+            column = self._column(base, counter, field, meta['count'], mode='r+')
+            column[positions] = values
+            column.flush()
+        return True
+
+    def positions(self, base, counter, timestamps):
+        """Row numbers of the given timestamps in the column files, None unless all are cached"""
+        meta = self.meta(base, counter)
+        if meta is None or not meta['count']:
+            return None
+        cached = self._column(base, counter, 'timestamp', meta['count'])
+        positions = np.searchsorted(cached, timestamps)
+        if np.any(positions >= len(cached)) or np.any(cached[np.minimum(positions, len(cached) - 1)] != timestamps):
+            return None
+        return positions
+
+    def pairs(self):
+        """The (base, counter) tuples of the cached pairs"""
+        if not os.path.exists(self.root):
+            return []
+        metas = [
+            json.load(open(os.path.join(self.root, name, 'meta.json'), 'r'))
+            for name in sorted(os.listdir(self.root))
+            if os.path.exists(os.path.join(self.root, name, 'meta.json'))
+        ]
+        return [tuple(meta['pair']) for meta in metas]
+
+    def invalidate(self, base, counter):
+        shutil.rmtree(self.path(base, counter), ignore_errors=True)
@@ -1,21 +1,52 @@
 import os
 import sys
-from datetime import datetime, timedelta
+from multiprocessing import Pool
 
 import pandas as pd
 from pandas import DataFrame
 from sqlalchemy import desc
 
+from butler.cache import CandleCache
 from butler.db import *
+from butler.export import NpyWriter, count_windows, iter_windows, split_masks
 from butler.indicators import *
-from settings import ensure_dir_exists
+from butler.integrity import SCAN_FIELDS, scan_database, scan_pair
+from butler.panel import build_panel
+from butler.registry import compute as compute_registry
+from butler.resample import resample
+from butler.shards import Manifest, write_shard
+from butler.windows import WindowDataset, feature_matrix, sliding_windows
+from candles import Candles, FIELDS, INDICATORS, OHLCV
+from settings import CACHE_ROOT, DATABASE_SETTINGS, INDICATOR_SETTINGS, ensure_dir_exists
 
-DEFAULT_DATABASE = {
-    'host': "localhost",
-    'name': "cccagg",
-    "user": 'root',
-    'pwd': 'root'
-}
+MA_PERIODS = (6, 12, 24)
+
+DEFAULT_DATABASE = DATABASE_SETTINGS
+
+
+# butler of a worker process of `_Butler.generate_split_files` and the like
+_worker_butler = None
+
+
+def _init_worker(db_configs, use_cache=False, use_catalog=False):
+    global _worker_butler
+    _worker_butler = _Butler(db_configs, use_cache=use_cache, use_catalog=use_catalog)
+
+
+def _export_pair(task):
+    return _worker_butler.export_pair(*task)
+
+
+def _export_pair_shards(task):
+    return _worker_butler.export_pair_shards(*task)
+
+
+def _integrity_report(pair):
+    return _worker_butler.integrity_report(*pair)
+
+
+def _compute_indicators(task):
+    return _worker_butler.compute_indicators(*task)
 
 
 class _Butler:
@@ -23,55 +54,113 @@ class _Butler:
     The Butler manages and manipulates the database. A butler can save and retrieve data
     from the database upon request, and identify invalid data
     """
-    def __init__(self, db_configs=None):
+    def __init__(self, db_configs=None, chunk_size=1000, use_cache=False, use_catalog=False):
+        """
+        :param db_configs: database connection settings, defaults to `DEFAULT_DATABASE`
+        :param chunk_size: number of rows written per statement
+        :param use_cache: serve columnar reads from a `CandleCache` under `settings.CACHE_ROOT`
+        :param use_catalog: keep the `pair_summary` table up to date and answer `all_pairs` and
+            `latest_timestamp` from it
+        """
         if db_configs is None:
             db_configs = DEFAULT_DATABASE
+        self.db_configs = db_configs
         self.Session = init_db(**db_configs)
+        self.chunk_size = chunk_size
+        self.candle_cache = CandleCache(CACHE_ROOT) if use_cache else None
+        self.use_catalog = use_catalog
+        if use_catalog:
+            session = self.Session()
+            empty = session.query(PairSummary.id).first() is None
+            session.close()
+            if empty:
+                self.refresh_catalog()
 
     def check_db_integrity(self, base, counter):
-        """Checks the data integrity of a given coin pair. False when candlesticks are not hourly coherent
-        or indicators not calculated
+        """Checks the data integrity of a given coin pair. False when candlesticks are not hourly coherent,
+        indicators not calculated or candlesticks made of zeros, see `integrity_report` for the details
 
         :param base: base coin
         :param counter: counter coin
         :return: boolean, indicating whether the pair is in good shape
         """
-        standard = timedelta(hours=1)
-        candles = self.retrieve_candlesticks(base, counter)
-        for i, c in enumerate(candles):
-            if i == 0:
-                continue
-            last = candles[i - 1]
-            t0 = last['timestamp']
-            t1 = c['timestamp']
-            delta = t1 - t0
-            if standard.total_seconds() != delta:
-                return False
-            if c['ma1'] is None:
-                return False
-        return True
+        return self.integrity_report(base, counter)['ok']
+
+    def integrity_report(self, base, counter):
+        """Report every gap, duplicate, zero candlestick and span of missing indicators of a coin
+        pair, see `butler.integrity.scan_pair`
+        """
+        values = self.read_candlesticks(base, counter, fields=SCAN_FIELDS)
+        return scan_pair(base.upper(), counter.upper(), values)
+
+    def integrity_reports(self, pairs=None, processes=1):
+        """Integrity reports of several coin pairs. All the pairs are scanned with a single
+        ordered query over the candlestick table by default, otherwise pair by pair
+
+        :param pairs: list of (base, counter) tuples, defaults to all the pairs in the database
+        :param processes: number of worker processes scanning pairs in parallel, None for the
+            number of CPUs; 1 scans in this process
+        :return: list of reports
+        """
+        if pairs is None and processes == 1:
+            session = self.Session()
+            try:
+                return scan_database(session)
+            finally:
+                session.close()
+        pairs = pairs or [p['pair'] for p in self.all_pairs()]
+        if processes == 1:
+            return [self.integrity_report(base, counter) for base, counter in pairs]
+        with Pool(processes, initializer=_init_worker, initargs=(self.db_configs, self.candle_cache is not None, self.use_catalog)) as pool:
+            return pool.map(_integrity_report, pairs)
 
     def all_pairs(self):
         """Summarize all the existing coin pairs and the number of corresponding
-        candlesticks data currently stored in the database
+        candlesticks data currently stored in the database, along with their first and last
+        timestamps and the number of candlesticks with indicators. Read from the catalog when
+        enabled, otherwise aggregated with a single query
 
-        :return:
+        :return: list of dicts, the most populated pair first
         """
         session = self.Session()
-        pairs = session.query(Candlestick.base, Candlestick.counter).distinct().all()
-        results = []
-        for base, counter in pairs:
-            count = session.query(Candlestick).filter(
-                Candlestick.base == base,
-                Candlestick.counter == counter
-            ).count()
-            obj = {
-                'pair': (base, counter),
-                'count': count
-            }
-            results.append(obj)
+        try:
+            if self.use_catalog:
+                results = [s.to_representation() for s in session.query(PairSummary).all()]
+            else:
+                results = summarize_pairs(session)
+        finally:
+            session.close()
         return sorted(results, key=lambda x: x['count'], reverse=True)
 
+    def refresh_catalog(self):
+        """Rebuild the `pair_summary` table from the candlesticks, e.g. after they were changed
+        by a butler without the catalog
+        """
+        session = self.Session()
+        try:
+            session.query(PairSummary).delete()
+            session.bulk_insert_mappings(PairSummary, [
+                dict(base=s['pair'][0], counter=s['pair'][1], count=s['count'], first=s['first'],
+                     last=s['last'], indicators=s['indicators'])
+                for s in summarize_pairs(session)
+            ])
+            session.commit()
+        finally:
+            session.close()
+
+    def _catalog_entry(self, session, base, counter):
+        """The catalog entry of a pair, aggregated from its candlesticks when missing"""
+        entry = session.query(PairSummary).filter(
+            PairSummary.base == base,
+            PairSummary.counter == counter
+        ).one_or_none()
+        if entry is None:
+            summary = summarize_pairs(session, base, counter)
+            summary = summary[0] if summary else {'count': 0, 'first': None, 'last': None, 'indicators': 0}
+            entry = PairSummary(base=base, counter=counter, count=summary['count'], first=summary['first'],
+                                last=summary['last'], indicators=summary['indicators'])
+            session.add(entry)
+        return entry
 
     def valid_candlestick(self, data):
         """Validate the candlestick data and identify valid ones
@@ -85,7 +174,7 @@ class _Butler:
                 return True
         return False
 
-    def save_candlesticks(self, data):
+    def save_candlesticks(self, data, chunk_size=None):
         """Save given candlesticks data into the database, each candlestick data has to
         be in the following format:
         {
@@ -97,108 +186,324 @@ class _Butler:
             "low": X.X,
             "volume": X.X
         }
+        Candlesticks are upserted in chunks against the `base_counter_time_uniq` constraint,
+        existing rows of the same pair and timestamp are updated in place
 
-        :param data: list of candlesticks data
-        :return: None
+        :param data: list of candlesticks data, or a `Candles`
+        :param chunk_size: number of rows written per statement, defaults to the butler's
+        :return: number of newly added candlesticks
         """
+        chunk_size = chunk_size or self.chunk_size
+        if isinstance(data, Candles):
+            data = data[data.valid()].to_records(OHLCV)
+        pairs = {}
+        for obj in data:
+            if not self.valid_candlestick(obj):
+                continue
+            pairs.setdefault((obj['base'], obj['counter']), []).append(obj)
+
         session = self.Session()
         added = 0
         updated = 0
         print("Saving candlestick data into database...")
-        for i, obj in enumerate(data):
-            progress = i / len(data) * 100
-            if progress % 10 - 0 < 1e-2:
-                print("Progress: {:.2f}%".format(progress))
-            if not self.valid_candlestick(obj):
-                continue
-            queryset = session.query(Candlestick).filter(
-                Candlestick.base == obj['base'],
-                Candlestick.counter == obj['counter'],
-                Candlestick.timestamp == obj['timestamp']
-            )
-            if queryset.count() == 0:
-                time = datetime.fromtimestamp(obj['timestamp'])
-                record = Candlestick(**obj, time=time)
-                session.add(record)
-                added += 1
-            else:
-                queryset.update(obj)
-                updated += 1
-        print("Progress: 100%")
-        session.commit()
-        print("Saving complete! {} new records saved.\n".format(added))
+        try:
+            for i, ((base, counter), rows) in enumerate(pairs.items()):
+                print("Progress: {:.2f}%".format(i / len(pairs) * 100))
+                a, u = upsert_candlesticks(session, base, counter, rows, chunk_size)
+                added += a
+                updated += u
+                if self.use_catalog:
+                    self._update_catalog(session, base, counter, rows, a)
+            print("Progress: 100%")
+            session.commit()
+        finally:
+            session.close()
+        print("Saving complete! {} new records saved, {} updated.\n".format(added, updated))
+        if self.candle_cache is not None:
+            for (base, counter), rows in pairs.items():
+                self._sync_cache(base.upper(), counter.upper(), min(r['timestamp'] for r in rows))
         return added
 
-    def retrieve_candlesticks(self, base, counter, start=None, end=None):
+    def _update_catalog(self, session, base, counter, rows, added):
+        """Account for candlesticks just upserted in the session in the pair's catalog entry"""
+        entry = session.query(PairSummary).filter(
+            PairSummary.base == base,
+            PairSummary.counter == counter
+        ).one_or_none()
+        if entry is None:
+            # aggregated after the upsert, the new candlesticks are already counted
+            self._catalog_entry(session, base, counter)
+            return
+        timestamps = [r['timestamp'] for r in rows]
+        entry.count += added
+        entry.first = min(timestamps) if entry.first is None else min(entry.first, min(timestamps))
+        entry.last = max(timestamps) if entry.last is None else max(entry.last, max(timestamps))
+
+    def _sync_cache(self, base, counter, first):
+        """Bring the cache of a pair up to date after saving candlesticks from timestamp
+        `first`: those hours are read back with their ids, the ones already cached are
+        overwritten in place and the newer ones appended. The pair is invalidated only when
+        hours were inserted before its latest cached one, e.g. when a gap is filled
+        """
+        meta = self.candle_cache.meta(base, counter)
+        if meta is None:
+            return
+        session = self.Session()
+        try:
+            values = select_candlesticks(session, base, counter, first, None, FIELDS)
+        finally:
+            session.close()
+        candles = Candles.from_columns(base, counter, **{f: values[:, i] for i, f in enumerate(FIELDS)})
+        timestamps = candles['timestamp']
+        cached = np.zeros(len(timestamps), dtype=bool) if meta['last'] is None else timestamps <= meta['last']
+        if cached.any():
+            updated = self.candle_cache.update(base, counter, timestamps[cached], **{
+                f: candles[f][cached] for f in FIELDS if f != 'timestamp'
+            })
+            if not updated:
+                return
+        self.candle_cache.append(candles[~cached])
+
+    def _cached_candlesticks(self, base, counter, start=None, end=None, fields=None):
+        """Read candlesticks from the cache, filling it from the database first when the pair
+        is not cached or its latest candlestick differs from the database's. Changes made
+        by other processes to hours already cached are not detected
+        """
+        meta = self.candle_cache.meta(base, counter)
+        if meta is None or meta['last'] != self.latest_timestamp(base, counter):
+            print("Filling the {}/{} cache from the database...".format(base, counter))
+            session = self.Session()
+            try:
+                values = select_candlesticks(session, base, counter, None, None, FIELDS)
+            finally:
+                session.close()
+            self.candle_cache.store(Candles.from_columns(base, counter, **{f: values[:, i] for i, f in enumerate(FIELDS)}))
+        return self.candle_cache.load(base, counter, start, end, fields)
+
+    def retrieve_candlesticks(self, base, counter, start=None, end=None, columnar=False, timeframe='1h'):
         """Retrieve candlestick data from the database
 
         :param base: base coin
         :param counter: counter coin
         :param start: starting timestamp
         :param end: ending timestamp, defaults to None (current time)
+        :param columnar: return a `Candles` read with `read_candlesticks` instead of ORM objects
+        :param timeframe: '1h', or one of the longer timeframes of `update_timeframes`
         :return: List of candlesticks
         """
+        if columnar:
+            return self.read_candlesticks(base, counter, start, end, output='candles', timeframe=timeframe)
         print("Retrieving data from the database...")
         base = base.upper()
         counter = counter.upper()
+        model = candlestick_model(timeframe)
         session = self.Session()
 
-        queryset = session.query(Candlestick).filter(
-            Candlestick.base == base,
-            Candlestick.counter == counter,
-        ).order_by(Candlestick.timestamp)
+        queryset = session.query(model).filter(
+            model.base == base,
+            model.counter == counter,
+        ).order_by(model.timestamp)
         if start is not None:
-            queryset = queryset.filter(Candlestick.timestamp >= start)
+            queryset = queryset.filter(model.timestamp >= start)
         if end is not None:
-            queryset = queryset.filter(Candlestick.timestamp <= end)
+            queryset = queryset.filter(model.timestamp <= end)
         queryset = queryset.all()
+        session.close()
         print("{} candlesticks for {}/{} retrieved.\n".format(len(queryset), base, counter))
         return [candle.to_representation() for candle in queryset]
 
-    def update_indicators(self, base, counter):
-
-        def update_db_instance(instance, ma1, ma2, ma3, mp, ms, md):
-            # if instance.ma1 != ma1:
-                instance.ma1 = ma1
-            # if instance.ma2 != ma2:
-                instance.ma2 = ma2
-            # if instance.ma3 != ma3:
-                instance.ma3 = ma3
-            # if instance.macd_proper != mp:
-                instance.macd_proper = mp
-            # if instance.macd_signal != ms:
-                instance.macd_signal = ms
-            # if instance.macd_diff != md:
-                instance.macd_diff = md
-
-        candlesticks = self.retrieve_candlesticks(base, counter)
-        prices = [c['close'] for c in candlesticks]
+    def read_candlesticks(self, base, counter, start=None, end=None, fields=None, output='array', timeframe='1h'):
+        """Fast retrieval of candlestick data, only the requested columns are selected and the
+        rows are streamed into NumPy arrays without building ORM objects. With the cache
+        enabled the candlesticks are read from the local column files instead
+
+        :param base: base coin
+        :param counter: counter coin
+        :param start: starting timestamp
+        :param end: ending timestamp
+        :param fields: names of the columns to read, defaults to the fields of `Candles`
+        :param output: 'array' for a 2-D float array with one column per field, 'dataframe',
+            or 'candles' for a `Candles`
+        :param timeframe: '1h', or one of the longer timeframes of `update_timeframes`, which are
+            never cached
+        :return: the candlesticks in the requested output
+        """
+        base = base.upper()
+        counter = counter.upper()
+        fields = list(fields or FIELDS)
+        if self.candle_cache is not None and timeframe == '1h':
+            candles = self._cached_candlesticks(base, counter, start, end, fields)
+            values = np.empty(shape=(len(candles), len(fields)))
+            for i, f in enumerate(fields):
+                values[:, i] = candles[f]
+        else:
+            print("Retrieving data from the database...")
+            session = self.Session()
+            try:
+                values = select_candlesticks(session, base, counter, start, end, fields, model=candlestick_model(timeframe))
+            finally:
+                session.close()
+        print("{} candlesticks for {}/{} retrieved.\n".format(len(values), base, counter))
+        if output == 'array':
+            return values
+        if output == 'dataframe':
+            return DataFrame(values, columns=fields)
+        if output == 'candles':
+            return Candles.from_columns(base, counter, **{f: values[:, i] for i, f in enumerate(fields)})
+        raise ValueError("Unknown output: {}".format(output))
+
+    def _trailing_closes(self, session, base, counter, timestamp, length):
+        """Close prices of the `length` candlesticks up to and including a timestamp, in time order"""
+        rows = session.query(Candlestick.close).filter(
+            Candlestick.base == base,
+            Candlestick.counter == counter,
+            Candlestick.timestamp <= timestamp
+        ).order_by(desc(Candlestick.timestamp)).limit(length).all()
+        return [r[0] for r in reversed(rows)]
+
+    def update_indicators(self, base, counter, incremental=True, chunk_size=None, since=None):
+        """Calculate the SMA and MACD indicators of a coin pair and save them into the database.
+        In incremental mode only the candlesticks newer than the stored indicator state are
+        loaded, along with the trailing close prices the SMAs need; a full calculation over
+        the whole history is done when the pair has no state yet, writing only the candlesticks
+        without indicators. Otherwise every calculated candlestick is written back, with bulk
+        updates by primary key committed chunk by chunk. After candlesticks were inserted in the
+        past, `since` recalculates the whole history and rewrites the candlesticks from the
+        first inserted one on, the EMAs of all the later ones having changed
+
+        :param base: base coin
+        :param counter: counter coin
+        :param incremental: resume from the stored state instead of recalculating and rewriting the
+            whole history
+        :param chunk_size: number of rows updated and committed at a time, defaults to the butler's
+        :param since: timestamp from which every candlestick is rewritten, implies a calculation
+            over the whole history
+        :return: None
+        """
+        base = base.upper()
+        counter = counter.upper()
+        session = self.Session()
+        state = session.query(IndicatorState).filter(
+            IndicatorState.base == base,
+            IndicatorState.counter == counter
+        ).one_or_none()
+
+        if since is None and incremental and state is not None:
+            candlesticks = self.retrieve_candlesticks(base, counter, start=state.timestamp + 1, columnar=True)
+            trailing = self._trailing_closes(session, base, counter, state.timestamp, max(MA_PERIODS) - 1)
+            init = (state.ema_fast, state.ema_slow, state.ema_signal)
+        else:
+            candlesticks = self.retrieve_candlesticks(base, counter, columnar=True)
+            trailing = []
+            init = None
+        if not len(candlesticks):
+            print("Indicators are up to date.\n")
+            session.close()
+            return
+        prices = candlesticks['close']
 
         print("Calculating extra indicators...")
-        ma6 = sma(prices, 6)
-        ma12 = sma(prices, 12)
-        ma24 = sma(prices, 24)
-        macd_proper, macd_signal, macd_diff = macd(prices)
+        ma6, ma12, ma24 = [sma(np.concatenate([trailing, prices]), n)[len(trailing):] for n in MA_PERIODS]
+        fast, slow, macd_signal = macd_components(prices, init=init)
+        macd_proper = fast - slow
+        macd_diff = macd_proper - macd_signal
 
         print("Calculation complete, updating database...")
-        session = self.Session()
-        for i, candle in enumerate(candlesticks):
-            progress = i / len(candlesticks) * 100
-            if progress % 10 - 0 < 1e-2:
-                print("Progress: {:.2f}%".format(progress))
-            if candle['ma1'] is not None:
-                continue
-            id = int(candle['id'])
-            new_candle = session.query(Candlestick).filter(Candlestick.id == id).one()
-            update_db_instance(
-                new_candle, ma6[i], ma12[i], ma24[i],
-                macd_proper[i], macd_signal[i], macd_diff[i]
-            )
+        if since is not None:
+            selected = candlesticks['timestamp'] >= since
+        elif incremental and init is None:
+            # first calculation of the pair, only the candlesticks without indicators are written
+            selected = np.isnan(candlesticks['ma1'])
+        else:
+            selected = np.ones(len(candlesticks), dtype=bool)
+        columns = [candlesticks['id'], ma6, ma12, ma24, macd_proper, macd_signal, macd_diff]
+        keys = ('id', 'ma1', 'ma2', 'ma3', 'macd_proper', 'macd_signal', 'macd_diff')
+        mappings = [dict(zip(keys, values)) for values in zip(*[c[selected].tolist() for c in columns])]
+        chunk_size = chunk_size or self.chunk_size
+        for i, chunk in enumerate(chunks(mappings, chunk_size)):
+            print("Progress: {:.2f}%".format(i * chunk_size / len(mappings) * 100))
+            session.bulk_update_mappings(Candlestick, chunk)
+            session.commit()
+        if self.candle_cache is not None:
+            self.candle_cache.update(base, counter, candlesticks['timestamp'][selected], **{
+                key: values[selected] for key, values in zip(keys[1:], columns[1:])
+            })
+        if self.use_catalog:
+            entry = self._catalog_entry(session, base, counter)
+            entry.indicators = len(candlesticks) if init is None else (entry.indicators or 0) + len(candlesticks)
+        if state is None:
+            state = IndicatorState(base=base, counter=counter)
+            session.add(state)
+        state.timestamp = int(candlesticks['timestamp'][-1])
+        state.ema_fast = float(fast[-1])
+        state.ema_slow = float(slow[-1])
+        state.ema_signal = float(macd_signal[-1])
         print("Progress: 100%")
         session.commit()
+        session.close()
         print("Update complete!\n")
 
+    def update_timeframes(self, base, counter, timeframes=('4h', '1d', '1w'), incremental=True):
+        """Roll the hourly candlesticks of a coin pair up into longer timeframes, see
+        `butler.resample`, and save them with their SMA and MACD indicators into the table of
+        each timeframe. In incremental mode only the hours from the latest stored candlestick
+        of each timeframe on are read, that candlestick being possibly still in progress; the
+        indicators are calculated over the whole series of the timeframe, much shorter than
+        the hourly one. Recalculate everything after hours were inserted in the past
+
+        :param base: base coin
+        :param counter: counter coin
+        :param timeframes: timeframes to update, among the keys of `butler.resample.TIMEFRAMES`
+        :param incremental: only roll up the latest hours instead of the whole history
+        :return: dict of the number of candlesticks written keyed by timeframe
+        """
+        base = base.upper()
+        counter = counter.upper()
+        chunk_size = self.chunk_size
+        session = self.Session()
+        try:
+            latest = {}
+            for timeframe in timeframes:
+                model = candlestick_model(timeframe)
+                row = session.query(model.timestamp).filter(
+                    model.base == base,
+                    model.counter == counter
+                ).order_by(desc(model.timestamp)).first()
+                latest[timeframe] = row[0] if incremental and row is not None else None
+            start = None if None in latest.values() else min(latest.values())
+            hourly = self.read_candlesticks(base, counter, start, fields=('timestamp', ) + OHLCV, output='candles')
+
+            written = {}
+            for timeframe in timeframes:
+                model = candlestick_model(timeframe)
+                hours = hourly if latest[timeframe] is None else hourly[hourly['timestamp'] >= latest[timeframe]]
+                rolled, counts = resample(hours, timeframe)
+                written[timeframe] = len(rolled)
+                if not len(rolled):
+                    continue
+                earlier = select_candlesticks(
+                    session, base, counter, end=int(rolled['timestamp'][0]) - 1, fields=['close'], model=model
+                )[:, 0]
+                prices = np.concatenate([earlier, rolled['close']])
+                for field, n in zip(('ma1', 'ma2', 'ma3'), MA_PERIODS):
+                    rolled.data[field] = sma(prices, n)[len(earlier):]
+                fast, slow, macd_signal = macd_components(prices)
+                rolled.data['macd_proper'] = (fast - slow)[len(earlier):]
+                rolled.data['macd_signal'] = macd_signal[len(earlier):]
+                rolled.data['macd_diff'] = rolled['macd_proper'] - rolled['macd_signal']
+                rows = rolled.to_records(OHLCV + INDICATORS)
+                for row, count in zip(rows, counts.tolist()):
+                    row['hours'] = count
+                upsert_candlesticks(session, base, counter, rows, chunk_size, model=model)
+            session.commit()
+        finally:
+            session.close()
+        print("{}/{} timeframes updated: {}\n".format(base, counter, written))
+        return written
+
     def as_dataframe(self, candlesticks):
+        if isinstance(candlesticks, Candles):
+            return candlesticks.to_dataframe()
         df = DataFrame(candlesticks)
         return df.drop(columns=['id', 'base', 'counter', 'time'])
 
@@ -223,6 +528,23 @@ class _Butler:
         print("Creation complete!\n")
         return x, y
 
+    def generate_windows(self, candlesticks, past_length=72, future_length=12, norm=True):
+        """Vectorized equivalent of `generate_past_future_pair` followed by `as_train_data`,
+        producing the training tensors directly
+
+        :param candlesticks: list of candlesticks or a `Candles`
+        :param past_length: number of candlesticks in the past part of a window
+        :param future_length: number of candlesticks in the future part of a window
+        :param norm: normalize each window like `normalize_pair`
+        :return: past tensor of shape (N, past_length, F) and future tensor of shape (N, future_length, F)
+        """
+        print("Creating past({})-future({}) pairs from given candlesticks...".format(past_length, future_length))
+        if not isinstance(candlesticks, Candles):
+            candlesticks = Candles.from_records(candlesticks)
+        x, y = sliding_windows(feature_matrix(candlesticks), past_length, future_length, norm)
+        print("Creation complete!\n")
+        return x, y
+
     def normalize_pair(self, past, future):
         merged = pd.concat([past, future])
 
@@ -262,31 +584,373 @@ class _Butler:
         np.save(path, tensor)
 
     def latest_timestamp(self, base, counter):
+        if self.use_catalog:
+            session = self.Session()
+            entry = session.query(PairSummary.last).filter(
+                PairSummary.base == base,
+                PairSummary.counter == counter
+            ).first()
+            session.close()
+            if entry is None or entry[0] is None:
+                sys.stderr.write("No {}/{} data in the database\n".format(base, counter))
+                return None
+            return entry[0]
         session = self.Session()
         latest = session.query(Candlestick).filter(
             Candlestick.base == base,
             Candlestick.counter == counter
         ).order_by(desc(Candlestick.timestamp)).first()
+        session.close()
         if latest is None:
             sys.stderr.write("No {}/{} data in the database\n".format(base, counter))
             return None
         return latest.timestamp
 
-    def generate_train_files(self, path, suffix, start=None, end=None):
-        pairs = self.all_pairs()
+    def count_candlesticks(self, base, counter, start=None, end=None, timeframe='1h'):
+        """Number of candlesticks of a coin pair stored between two timestamps"""
+        model = candlestick_model(timeframe)
+        session = self.Session()
+        queryset = session.query(model.id).filter(
+            model.base == base,
+            model.counter == counter
+        )
+        if start is not None:
+            queryset = queryset.filter(model.timestamp >= start)
+        if end is not None:
+            queryset = queryset.filter(model.timestamp <= end)
+        count = queryset.count()
+        session.close()
+        return count
+
+    def generate_train_files(self, path, suffix, start=None, end=None, limit=1_000_000, chunk_size=10000,
+                             timeframe='1h'):
+        """Generate the training tensors of all the pairs between two timestamps and save them as
+        `x_{suffix}.npy` and `y_{suffix}.npy`. The files are sized up front from the candlestick
+        counts and the windows are streamed into them pair by pair, `chunk_size` at a time
+
+        :param path: directory of the files
+        :param suffix: name of the split, e.g. 'train'
+        :param start: starting timestamp
+        :param end: ending timestamp
+        :param limit: pairs stop being added once this many candlesticks are included, None for no limit
+        :param chunk_size: number of windows generated at a time
+        :param timeframe: timeframe of the candlesticks, see `update_timeframes`
+        :return: None
+        """
+        pairs = [
+            (base, counter, self.count_candlesticks(base, counter, start, end, timeframe))
+            for base, counter in self._pair_selection(limit)
+        ]
+
+        size = sum(count_windows(count, 72, 12) for _, _, count in pairs)
+        writer = NpyWriter(path, suffix, size, 72, 12)
+        for base, counter, count in pairs:
+            if not count_windows(count, 72, 12):
+                continue
+            candlesticks = self.retrieve_candlesticks(base, counter, start, end, columnar=True, timeframe=timeframe)
+            print("Creating past(72)-future(12) pairs for {}/{}...".format(base, counter))
+            for inputs, outputs in iter_windows(feature_matrix(candlesticks), 72, 12, True, chunk_size):
+                writer.write(inputs, outputs)
+        writer.close()
+        print("Creation complete!\n")
+
+    def _pair_selection(self, limit):
+        """Pairs included in training files, the most populated first until `limit` candlesticks"""
+        pairs = []
         total_count = 0
-        x, y = [], []
-        for i in pairs:
-            if total_count > 1_000_000:
+        for i in self.all_pairs():
+            if limit is not None and total_count > limit:
                 break
             total_count += i['count']
-            base, counter = i['pair']
-            candlesticks = self.retrieve_candlesticks(base, counter, start, end)
-            past, future = self.generate_past_future_pair(candlesticks, 72, 12, norm=True)
-            inputs, outputs = self.as_train_data(past, future)
-            x += inputs
-            y += outputs
-        x = np.array(x)
-        y = np.array(y)
-        self.cache(x, os.path.join(path, 'x_{}.npy'.format(suffix)))
-        self.cache(y, os.path.join(path, 'y_{}.npy'.format(suffix)))
+            pairs.append(i['pair'])
+        return pairs
+
+    def export_pair(self, base, counter, splits, path, offsets, sizes, chunk_size=10000):
+        """Compute the windows of a pair once over the time range of all the splits and write
+        each window into the files of the split it belongs to, in the region reserved for the pair
+
+        :param base: base coin
+        :param counter: counter coin
+        :param splits: list of tuples of the split name, starting and ending timestamps
+        :param path: directory of the files, created by `generate_split_files`
+        :param offsets: dict of the index of the pair's first window in the files of each split
+        :param sizes: dict of the number of windows reserved for the pair in each split
+        :param chunk_size: number of windows generated at a time
+        :return: dict of the number of windows written keyed by split name
+        """
+        writers = {
+            suffix: NpyWriter.region(path, suffix, offsets[suffix], size)
+            for suffix, size in sizes.items() if size
+        }
+        for suffix, x, y in self._pair_split_windows(base, counter, splits, chunk_size):
+            if suffix in writers:
+                writers[suffix].write(x, y)
+        counts = {}
+        for suffix, writer in writers.items():
+            writer.close()
+            counts[suffix] = writer.offset
+        return counts
+
+    def generate_split_files(self, path, splits, limit=1_000_000, processes=None, chunk_size=10000):
+        """Generate the training files of several splits with one retrieval per pair. The files
+        are sized up front from the candlestick counts of every pair in every split, which also
+        reserves each pair a region of the files. Pairs are then distributed over a pool of
+        processes, each computing the windows of a pair once and writing them into its regions
+        of the split files they belong to by timestamp. The files hold the same windows in the
+        same order as `generate_train_files` writes them, whatever order the pairs complete in
+
+        :param path: directory of the files
+        :param splits: list of tuples of the split name, starting and ending timestamps (None for unbounded)
+        :param limit: pairs stop being added once this many candlesticks are included, None for no limit
+        :param processes: number of worker processes, defaults to the number of CPUs; 1 runs in
+            this process
+        :param chunk_size: number of windows generated at a time
+        :return: None
+        """
+        pairs = self._pair_selection(limit)
+        sizes = {
+            suffix: [count_windows(self.count_candlesticks(base, counter, start, end), 72, 12) for base, counter in pairs]
+            for suffix, start, end in splits
+        }
+        tasks = []
+        for i, (base, counter) in enumerate(pairs):
+            offsets = {suffix: sum(sizes[suffix][:i]) for suffix, _, _ in splits}
+            pair_sizes = {suffix: sizes[suffix][i] for suffix, _, _ in splits}
+            tasks.append((base, counter, splits, path, offsets, pair_sizes, chunk_size))
+        for suffix, _, _ in splits:
+            NpyWriter.allocate(path, suffix, sum(sizes[suffix]), 72, 12)
+
+        if processes == 1:
+            results = [self.export_pair(*task) for task in tasks]
+        else:
+            with Pool(processes, initializer=_init_worker, initargs=(self.db_configs, self.candle_cache is not None, self.use_catalog)) as pool:
+                results = list(pool.imap_unordered(_export_pair, tasks))
+        for suffix, _, _ in splits:
+            written = sum(counts.get(suffix, 0) for counts in results)
+            if written != sum(sizes[suffix]):
+                sys.stderr.write("{}: {} of {} windows written\n".format(suffix, written, sum(sizes[suffix])))
+        print("Creation complete!\n")
+
+    def _window_start(self, base, counter, end, past_length=72, future_length=12):
+        """Timestamp of the first candlestick of the earliest window ending after `end`, None when
+        there are not enough candlesticks up to `end` for such a window to start before it
+        """
+        session = self.Session()
+        rows = session.query(Candlestick.timestamp).filter(
+            Candlestick.base == base,
+            Candlestick.counter == counter,
+            Candlestick.timestamp <= end
+        ).order_by(desc(Candlestick.timestamp)).limit(past_length + future_length - 1).all()
+        session.close()
+        if len(rows) < past_length + future_length - 1:
+            return None
+        return rows[-1][0]
+
+    def _pair_split_windows(self, base, counter, splits, chunk_size=10000, after=None):
+        """Retrieve a pair once over the time range of all the splits and generate its windows
+
+        :param after: dict of timestamps keyed by split name, only windows ending after it are
+            generated for the split
+        :return: generator of tuples of the split name and the past and future tensors of a chunk of windows
+        """
+        after = after or {}
+        starts = []
+        for suffix, start, _ in splits:
+            if after.get(suffix) is not None:
+                window_start = self._window_start(base, counter, after[suffix], 72, 12)
+                if window_start is not None:
+                    start = window_start if start is None else max(start, window_start)
+            starts.append(start)
+        ends = [end for _, _, end in splits]
+        start = None if None in starts else min(starts)
+        end = None if None in ends else max(ends)
+        candlesticks = self.retrieve_candlesticks(base, counter, start, end, columnar=True)
+        masks = split_masks(candlesticks['timestamp'], splits, 72, 12)
+        for suffix, mask in masks.items():
+            if after.get(suffix) is not None:
+                mask &= candlesticks['timestamp'][72 + 12 - 1:] > after[suffix]
+        print("Creating past(72)-future(12) pairs for {}/{}...".format(base, counter))
+        offset = 0
+        for inputs, outputs in iter_windows(feature_matrix(candlesticks), 72, 12, True, chunk_size):
+            for suffix, mask in masks.items():
+                mask = mask[offset:offset + len(inputs)]
+                if mask.any():
+                    yield suffix, inputs[mask], outputs[mask]
+            offset += len(inputs)
+
+    def export_pair_shards(self, base, counter, splits, path, shard_size=10000, after=None):
+        """Write the windows of a pair into shards of at most `shard_size` windows per split
+
+        :param after: dict of timestamps keyed by split name, only windows ending after it are written
+        :return: list of the manifest entries of the shards
+        """
+        return [
+            write_shard(path, suffix, base, counter, x, y, norm=True)
+            for suffix, x, y in self._pair_split_windows(base, counter, splits, shard_size, after)
+        ]
+
+    def generate_shards(self, path, splits, limit=1_000_000, processes=None, shard_size=10000, incremental=False):
+        """Generate a sharded dataset: the windows of every pair and split are saved in shards of
+        at most `shard_size` windows, indexed by a JSON manifest recording the pair, split, time
+        range, window lengths and normalization of each shard. New shards are added to an
+        existing dataset in the same directory, in incremental mode only the windows newer than
+        the dataset are generated. Read it back with `butler.shards.ShardedDataset`
+
+        :param path: directory of the dataset
+        :param splits: list of tuples of the split name, starting and ending timestamps (None for unbounded)
+        :param limit: pairs stop being added once this many candlesticks are included, None for no limit
+        :param processes: number of worker processes, defaults to the number of CPUs; 1 runs in
+            this process
+        :param shard_size: maximum number of windows per shard
+        :param incremental: only export the windows ending after the last window already in the
+            dataset for each pair and split, as recorded by the manifest
+        :return: the manifest
+        """
+        manifest = Manifest(path)
+        tasks = []
+        for base, counter in self._pair_selection(limit):
+            after = None
+            if incremental:
+                after = {suffix: manifest.last_end(base, counter, suffix) for suffix, _, _ in splits}
+            tasks.append((base, counter, splits, path, shard_size, after))
+        if processes == 1:
+            results = [self.export_pair_shards(*task) for task in tasks]
+        else:
+            with Pool(processes, initializer=_init_worker, initargs=(self.db_configs, self.candle_cache is not None, self.use_catalog)) as pool:
+                results = pool.map(_export_pair_shards, tasks)
+        for entries in results:
+            manifest.add(entries)
+        manifest.save()
+        print("{} shards written.\n".format(sum(len(entries) for entries in results)))
+        return manifest
+
+    def window_dataset(self, start=None, end=None, pairs=None, limit=1_000_000,
+                       past_length=72, future_length=12, norm=True, dtype=np.float32):
+        """Build a `WindowDataset` over the candlesticks of several pairs between two timestamps.
+        Memory grows with the number of candlesticks rather than with the number of windows
+
+        :param start: starting timestamp
+        :param end: ending timestamp
+        :param pairs: list of (base, counter) tuples, defaults to the pairs `generate_train_files` uses
+        :param limit: when `pairs` is not given, pairs stop being added once this many candlesticks are included
+        :param past_length: number of candlesticks in the past part of a window
+        :param future_length: number of candlesticks in the future part of a window
+        :param norm: normalize each window like `normalize_pair`
+        :param dtype: data type of the stored features and of the windows produced
+        :return: the dataset
+        """
+        candles = [
+            self.retrieve_candlesticks(base, counter, start, end, columnar=True)
+            for base, counter in pairs or self._pair_selection(limit)
+        ]
+        return WindowDataset(candles, past_length, future_length, norm, dtype)
+
+    def panel(self, pairs=None, start=None, end=None, fields=None, fill=None, timeframe='1h'):
+        """Read several coin pairs with a single query aligned on a common time index, e.g. every
+        coin of the watchlist against BTC on the same hours, see `butler.panel.build_panel`
+
+        :param pairs: list of (base, counter) tuples, defaults to every pair in the database
+        :param start: starting timestamp, defaults to the first candlestick of the pairs
+        :param end: ending timestamp, defaults to the last candlestick of the pairs
+        :param fields: names of the columns to read, defaults to OHLCV and the indicators
+        :param fill: None to leave missing hours NaN, 'ffill' to carry the last values forward
+            with zero volume, or a number to fill with
+        :param timeframe: '1h', or one of the longer timeframes of `update_timeframes`
+        :return: a `Panel` holding a float32 array of shape (time, pair, field)
+        """
+        summaries = self.all_pairs()
+        if pairs is None:
+            pairs = sorted(s['pair'] for s in summaries)
+        pairs = [(base.upper(), counter.upper()) for base, counter in pairs]
+        if start is None or end is None:
+            selected = [s for s in summaries if tuple(s['pair']) in set(pairs) and s['count']]
+            if not selected:
+                raise ValueError("No candlesticks of the requested pairs in the database")
+            start = min(s['first'] for s in selected) if start is None else start
+            end = max(s['last'] for s in selected) if end is None else end
+        session = self.Session()
+        try:
+            return build_panel(session, pairs, fields or OHLCV + INDICATORS, start, end, fill,
+                               timeframe, candlestick_model(timeframe))
+        finally:
+            session.close()
+
+    def compute_indicators(self, base, counter, specs=None, incremental=True):
+        """Compute the indicators of the registry, see `butler.registry`, for a coin pair in one
+        pass over its OHLCV arrays and store them in the `indicator_series` table, one row per
+        indicator output. Every indicator is calculated over the whole history, which the cache
+        serves without touching the database when enabled, while in incremental mode the
+        stored values are kept and only the newer ones appended, so a newly configured
+        indicator gets its whole history
+
+        :param base: base coin
+        :param counter: counter coin
+        :param specs: list of tuples of the kind and parameters of each indicator, defaults to
+            `INDICATOR_SETTINGS['indicators']`
+        :param incremental: only append new values instead of replacing all of them
+        :return: number of values written
+        """
+        base = base.upper()
+        counter = counter.upper()
+        specs = specs or INDICATOR_SETTINGS['indicators']
+        candles = self.read_candlesticks(base, counter, fields=('timestamp', ) + OHLCV, output='candles')
+        values = compute_registry({f: candles[f] for f in OHLCV}, specs)
+        timestamps = candles['timestamp'].astype(np.int64)
+
+        session = self.Session()
+        try:
+            series = {name: (timestamps, column) for name, column in values.items()}
+            written = len(timestamps) * len(values)
+            if incremental:
+                for name, (times, stored) in load_indicator_series(session, base, counter, list(values)).items():
+                    newer = timestamps > times[-1] if len(times) else np.ones(len(timestamps), dtype=bool)
+                    written -= len(timestamps) - np.count_nonzero(newer)
+                    if not newer.any():
+                        del series[name]
+                        continue
+                    series[name] = (np.concatenate([times, timestamps[newer]]),
+                                    np.concatenate([stored, values[name][newer]]))
+            store_indicator_series(session, base, counter, series)
+            session.commit()
+        finally:
+            session.close()
+        print("{} indicator values of {}/{} written.\n".format(written, base, counter))
+        return written
+
+    def compute_all_indicators(self, specs=None, processes=None):
+        """Recompute the indicators of the registry for every pair, pairs being spread over a
+        pool of processes
+
+        :param specs: list of tuples of the kind and parameters of each indicator, defaults to
+            `INDICATOR_SETTINGS['indicators']`
+        :param processes: number of worker processes, defaults to the number of CPUs; 1 runs in
+            this process
+        :return: dict of the number of values written keyed by pair
+        """
+        tasks = [(base, counter, specs, False) for base, counter in (p['pair'] for p in self.all_pairs())]
+        if processes == 1:
+            results = [self.compute_indicators(*task) for task in tasks]
+        else:
+            with Pool(processes, initializer=_init_worker,
+                      initargs=(self.db_configs, self.candle_cache is not None, self.use_catalog)) as pool:
+                results = pool.map(_compute_indicators, tasks)
+        return {(task[0], task[1]): written for task, written in zip(tasks, results)}
+
+    def read_indicators(self, base, counter, names=None, start=None, end=None):
+        """Read stored indicators of the registry of a coin pair
+
+        :param base: base coin
+        :param counter: counter coin
+        :param names: output names to read, see `butler.registry.output_names`, defaults to all
+        :param start: starting timestamp
+        :param end: ending timestamp
+        :return: DataFrame with a timestamp column and one column per indicator
+        """
+        session = self.Session()
+        try:
+            timestamps, names, values = select_indicator_values(session, base.upper(), counter.upper(), names, start, end)
+        finally:
+            session.close()
+        df = DataFrame(values, columns=names)
+        df.insert(0, 'timestamp', timestamps)
+        return df
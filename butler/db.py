@@ -1,8 +1,15 @@
+import os
+from datetime import datetime
+from itertools import groupby
 
-from sqlalchemy import Column, String, Integer, Float, create_engine, UniqueConstraint, DateTime
+from sqlalchemy import Column, String, Integer, Float, LargeBinary, create_engine, UniqueConstraint, DateTime, and_, or_, bindparam, select, event, func
+from sqlalchemy.dialects.mysql import LONGBLOB
 from sqlalchemy.ext.declarative import declarative_base
 import numpy as np
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from settings import ROOT_DIR, ensure_dir_exists
 
 Base = declarative_base()
 
@@ -16,9 +23,8 @@ def _json_repr(value):
     return repr
 
 
-class Candlestick(Base):
-    __tablename__ = 'candlestick'
-
+class CandlestickColumns(object):
+    """Columns shared by the candlesticks of every timeframe"""
     id = Column(Integer, primary_key=True)
     base = Column(String(10))
     counter = Column(String(10))
@@ -36,14 +42,21 @@ class Candlestick(Base):
     macd_signal = Column(Float)
     macd_diff = Column(Float)
 
-    __table_args__ = (UniqueConstraint('base', 'counter', 'timestamp', name='base_counter_time_uniq'),)
-
     def __repr__(self):
         return "<{}/{} - o: {:.3f} h: {:.3f} l: {:.3f} c:{:.3f} v:{:.3f}>".format(
             self.base, self.counter,
             self.open, self.high, self.low, self.close, self.volume
         )
 
+    def to_representation(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns }
+
+
+class Candlestick(CandlestickColumns, Base):
+    __tablename__ = 'candlestick'
+
+    __table_args__ = (UniqueConstraint('base', 'counter', 'timestamp', name='base_counter_time_uniq'),)
+
     def as_vector(self, column_vector=False):
         v = np.array([self.open, self.high, self.low, self.close, self.volume])
         v = v.reshape(-1, 1)
@@ -51,11 +64,260 @@ class Candlestick(Base):
             v = v.T
         return v
 
+
+def _timeframe_model(timeframe):
+    """Model of the candlesticks rolled up from hourly ones into a longer timeframe, the number
+    of hourly candlesticks of each is kept to tell complete ones from those still in progress
+    """
+    return type('Candlestick' + timeframe.upper(), (CandlestickColumns, Base), {
+        '__tablename__': 'candlestick_' + timeframe,
+        'hours': Column(Integer),
+        '__table_args__': (UniqueConstraint('base', 'counter', 'timestamp', name='base_counter_time_uniq_' + timeframe),)
+    })
+
+
+# candlestick models keyed by timeframe
+TIMEFRAME_MODELS = {'1h': Candlestick}
+TIMEFRAME_MODELS.update((timeframe, _timeframe_model(timeframe)) for timeframe in ('4h', '1d', '1w'))
+
+
+def candlestick_model(timeframe='1h'):
+    if timeframe not in TIMEFRAME_MODELS:
+        raise ValueError("Unknown timeframe: {}, expected one of {}".format(timeframe, list(TIMEFRAME_MODELS)))
+    return TIMEFRAME_MODELS[timeframe]
+
+
+class IndicatorState(Base):
+    """The EMA values behind the MACD of the latest candlestick whose indicators are calculated,
+    so that indicators of newer candlesticks can be calculated without the full history
+    """
+    __tablename__ = 'indicator_state'
+
+    id = Column(Integer, primary_key=True)
+    base = Column(String(10))
+    counter = Column(String(10))
+    timestamp = Column(Integer)
+    ema_fast = Column(Float)
+    ema_slow = Column(Float)
+    ema_signal = Column(Float)
+
+    __table_args__ = (UniqueConstraint('base', 'counter', name='state_base_counter_uniq'),)
+
+
+class IndicatorSeries(Base):
+    """Storage of the indicators of `butler.registry`, one row per pair and indicator output
+    holding the whole series as raw int64 timestamps and float64 values, so that new indicators
+    need no schema change and a pair is written with a handful of rows rather than one per hour
+    """
+    __tablename__ = 'indicator_series'
+
+    id = Column(Integer, primary_key=True)
+    base = Column(String(10))
+    counter = Column(String(10))
+    name = Column(String(40))
+    count = Column(Integer)
+    first = Column(Integer)
+    last = Column(Integer)
+    timestamps = Column(LargeBinary().with_variant(LONGBLOB, 'mysql'))
+    values = Column(LargeBinary().with_variant(LONGBLOB, 'mysql'))
+
+    __table_args__ = (UniqueConstraint('base', 'counter', 'name', name='indicator_series_uniq'),)
+
+
+def load_indicator_series(session, base, counter, names=None):
+    """Stored indicator series of a pair
+
+    :param names: output names to load, defaults to all
+    :return: dict of tuples of the int64 timestamps and float64 values keyed by name
+    """
+    query = session.query(IndicatorSeries.name, IndicatorSeries.timestamps, IndicatorSeries.values).filter(
+        IndicatorSeries.base == base,
+        IndicatorSeries.counter == counter
+    )
+    if names is not None:
+        query = query.filter(IndicatorSeries.name.in_(list(names)))
+    return {
+        name: (np.frombuffer(timestamps, dtype=np.int64), np.frombuffer(values, dtype=np.float64))
+        for name, timestamps, values in query.all()
+    }
+
+
+def store_indicator_series(session, base, counter, series):
+    """Replace indicator series of a pair, one row per series
+
+    :param session: database session, the caller is responsible for committing
+    :param series: dict of tuples of the timestamps and values keyed by name
+    :return: None
+    """
+    if not series:
+        return
+    session.query(IndicatorSeries).filter(
+        IndicatorSeries.base == base,
+        IndicatorSeries.counter == counter,
+        IndicatorSeries.name.in_(list(series))
+    ).delete(synchronize_session=False)
+    rows = []
+    for name, (timestamps, values) in series.items():
+        timestamps = np.ascontiguousarray(timestamps, dtype=np.int64)
+        rows.append({
+            'base': base, 'counter': counter, 'name': name, 'count': len(timestamps),
+            'first': int(timestamps[0]) if len(timestamps) else None,
+            'last': int(timestamps[-1]) if len(timestamps) else None,
+            'timestamps': timestamps.tobytes(),
+            'values': np.ascontiguousarray(values, dtype=np.float64).tobytes()
+        })
+    session.bulk_insert_mappings(IndicatorSeries, rows)
+
+
+def select_indicator_values(session, base, counter, names=None, start=None, end=None):
+    """Read indicator values of a pair into one column per indicator
+
+    :return: tuple of the int array of timestamps, in time order, and the list of names and
+        the 2-D float array of values with one column per name, NaN where a value is missing
+    """
+    series = load_indicator_series(session, base, counter, names)
+    names = list(names) if names is not None else sorted(series)
+    found = [series[n][0] for n in names if n in series]
+    timestamps = np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
+    lo = 0 if start is None else np.searchsorted(timestamps, start, side='left')
+    hi = len(timestamps) if end is None else np.searchsorted(timestamps, end, side='right')
+    timestamps = timestamps[lo:hi]
+    matrix = np.full((len(timestamps), len(names)), np.nan)
+    for i, name in enumerate(names):
+        if name in series:
+            times, values = series[name]
+            selected = np.isin(times, timestamps)
+            matrix[np.searchsorted(timestamps, times[selected]), i] = values[selected]
+    return timestamps, names, matrix
+
+
+class PairSummary(Base):
+    """Catalog entry of a coin pair: number of candlesticks, time range and number of candlesticks
+    with indicators, maintained as candlesticks are saved and indicators updated
+    """
+    __tablename__ = 'pair_summary'
+
+    id = Column(Integer, primary_key=True)
+    base = Column(String(10))
+    counter = Column(String(10))
+    count = Column(Integer)
+    first = Column(Integer)
+    last = Column(Integer)
+    indicators = Column(Integer)
+
+    __table_args__ = (UniqueConstraint('base', 'counter', name='summary_base_counter_uniq'),)
+
     def to_representation(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns }
+        return {
+            'pair': (self.base, self.counter),
+            'count': self.count,
+            'first': self.first,
+            'last': self.last,
+            'indicators': self.indicators
+        }
+
+
+def summarize_pairs(session, base=None, counter=None):
+    """Aggregate the candlesticks of every pair, or of a single one, with one GROUP BY query
+
+    :return: list of dicts of the pair, the number of candlesticks, the first and last
+        timestamps and the number of candlesticks with indicators, in the format of
+        `PairSummary.to_representation`
+    """
+    table = Candlestick.__table__
+    stmt = select([
+        table.c.base, table.c.counter,
+        func.count(table.c.id), func.min(table.c.timestamp), func.max(table.c.timestamp), func.count(table.c.ma1)
+    ]).group_by(table.c.base, table.c.counter)
+    if base is not None:
+        stmt = stmt.where(and_(table.c.base == base, table.c.counter == counter))
+    return [
+        {'pair': (b, c), 'count': count, 'first': first, 'last': last, 'indicators': indicators}
+        for b, c, count, first, last, indicators in session.execute(stmt)
+    ]
 
 
-def init_db(host, name, user, pwd):
+def select_candlesticks(session, base, counter, start=None, end=None, fields=None, batch_size=10000, model=Candlestick):
+    """Read the given columns of a coin pair's candlesticks straight into a float array with a
+    Core select, rows are streamed from a server-side cursor `batch_size` at a time rather than
+    fetched all at once. The filter on base and counter with the ordering on timestamp is
+    served by the `base_counter_time_uniq` index
+
+    :param session: database session
+    :param base: base coin
+    :param counter: counter coin
+    :param start: starting timestamp
+    :param end: ending timestamp
+    :param fields: names of the columns to read, defaults to all
+    :param batch_size: number of rows fetched at a time
+    :param model: candlestick model of the timeframe to read, see `candlestick_model`
+    :return: 2-D float array with one row per candlestick and one column per field, None becoming NaN
+    """
+    table = model.__table__
+    fields = fields or [c.name for c in table.columns]
+    stmt = select([table.c[f] for f in fields]).where(and_(
+        table.c.base == base,
+        table.c.counter == counter
+    )).order_by(table.c.timestamp)
+    if start is not None:
+        stmt = stmt.where(table.c.timestamp >= start)
+    if end is not None:
+        stmt = stmt.where(table.c.timestamp <= end)
+    result = session.connection().execution_options(stream_results=True).execute(stmt)
+    blocks = []
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        # plain tuples convert several times faster than result rows
+        blocks.append(np.array(list(map(tuple, rows)), dtype=np.float64))
+    result.close()
+    if not blocks:
+        return np.zeros(shape=(0, len(fields)))
+    return np.concatenate(blocks)
+
+
+def iter_pairs(session, fields, pairs=None, start=None, end=None, batch_size=10000, model=Candlestick):
+    """Stream the given columns of several pairs with a single query ordered by pair and time,
+    served by the `base_counter_time_uniq` index, one pair at a time
+
+    :param session: database session
+    :param fields: names of the columns to read
+    :param pairs: list of (base, counter) tuples, defaults to every pair
+    :param start: starting timestamp
+    :param end: ending timestamp
+    :param batch_size: number of rows fetched at a time
+    :param model: candlestick model of the timeframe to read, see `candlestick_model`
+    :return: generator of tuples of base, counter and a float array with one column per field
+    """
+    table = model.__table__
+    stmt = select([table.c.base, table.c.counter] + [table.c[f] for f in fields]).order_by(
+        table.c.base, table.c.counter, table.c.timestamp
+    )
+    if pairs is not None:
+        stmt = stmt.where(or_(*[and_(table.c.base == b, table.c.counter == c) for b, c in pairs]))
+    if start is not None:
+        stmt = stmt.where(table.c.timestamp >= start)
+    if end is not None:
+        stmt = stmt.where(table.c.timestamp <= end)
+    result = session.connection().execution_options(stream_results=True).execute(stmt)
+    current, blocks = None, []
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for pair, group in groupby(rows, key=lambda r: (r[0], r[1])):
+            if pair != current:
+                if current is not None:
+                    yield current[0], current[1], np.concatenate(blocks)
+                current, blocks = pair, []
+            blocks.append(np.array([tuple(r[2:]) for r in group], dtype=np.float64))
+    result.close()
+    if current is not None:
+        yield current[0], current[1], np.concatenate(blocks)
+
+
+def _mysql_engine(host, name, user, pwd):
     url = '{dialect}+{driver}://{username}:{password}@{host}/{db}?charset=utf8'.format(
         dialect='mysql',
         driver='mysqldb',
@@ -64,7 +326,134 @@ def init_db(host, name, user, pwd):
         host=host,
         db=name
     )
-    engine = create_engine(url)
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
+    return create_engine(url)
+
+
+def _sqlite_engine(path):
+    """A SQLite engine tuned for a single writer: write-ahead logging so reads are not blocked by
+    writes, fsync at checkpoints only, and a busy timeout instead of failing on a locked
+    database. Connections can be shared across threads, the butler's sessions never are
+    """
+    if path == ':memory:':
+        engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    else:
+        ensure_dir_exists(os.path.dirname(os.path.abspath(path)))
+        engine = create_engine('sqlite:///' + path, connect_args={'check_same_thread': False, 'timeout': 30})
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(connection, _):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA cache_size=-65536')
+        cursor.close()
+
+    return engine
+
+
+def init_db(host=None, name=None, user=None, pwd=None, engine='mysql', path=None):
+    """Connect to the database, creating the tables and their indexes if needed
+
+    :param host: MySQL server host
+    :param name: MySQL schema name
+    :param user: MySQL user name
+    :param pwd: MySQL password
+    :param engine: 'mysql', or 'sqlite' for a single database file needing no server
+    :param path: SQLite database file, ':memory:' for a transient database
+    :return: a session factory
+    """
+    if engine == 'mysql':
+        db = _mysql_engine(host, name, user, pwd)
+    elif engine == 'sqlite':
+        db = _sqlite_engine(path or os.path.join(ROOT_DIR, 'data', 'cccagg.sqlite'))
+    elif engine == 'file':
+        raise ValueError("The file engine has no SQL database and cannot back a Butler, it is only "
+                         "available through `butler.storage.open_storage`")
+    else:
+        raise ValueError("Unknown database engine: {}".format(engine))
+    Base.metadata.create_all(db)
+    Session = sessionmaker(bind=db)
     return Session
+
+
+def chunks(seq, size):
+    """Split a sequence into consecutive slices of at most `size` items"""
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _existing_timestamps(session, base, counter, timestamps, model=Candlestick):
+    """Find which of the given timestamps already have a row for the pair, using a single
+    range query over the `base_counter_time_uniq` index
+    """
+    rows = session.query(model.timestamp).filter(
+        model.base == base,
+        model.counter == counter,
+        model.timestamp >= min(timestamps),
+        model.timestamp <= max(timestamps)
+    ).all()
+    return {r[0] for r in rows}.intersection(timestamps)
+
+
+def _upsert_statement(dialect, table, rows, update_columns):
+    """Build a multi-row INSERT that resolves `base_counter_time_uniq` conflicts by updating
+    the given columns, None if the dialect has no such syntax
+    """
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table).values(rows)
+        return stmt.on_duplicate_key_update(**{c: stmt.inserted[c] for c in update_columns})
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(table).values(rows)
+        return stmt.on_conflict_do_update(
+            index_elements=['base', 'counter', 'timestamp'],
+            set_={c: stmt.excluded[c] for c in update_columns}
+        )
+    return None
+
+
+def upsert_candlesticks(session, base, counter, rows, chunk_size=1000, model=Candlestick):
+    """Insert or update the candlesticks of a single coin pair in batches. Each chunk costs
+    one range query to tell new rows from existing ones and one multi-row upsert, dialects
+    without upsert syntax fall back to an executemany INSERT plus an executemany UPDATE
+
+    :param session: database session, the caller is responsible for committing
+    :param base: base coin
+    :param counter: counter coin
+    :param rows: candlestick dicts of the pair, in the format of `save_candlesticks`
+    :param chunk_size: number of rows written per statement
+    :param model: candlestick model of the timeframe to write, see `candlestick_model`
+    :return: tuple of the numbers of added and updated rows
+    """
+    table = model.__table__
+    dialect = session.bind.dialect.name
+    # the last occurrence of a timestamp wins, as it would with row by row updates
+    rows = list({r['timestamp']: r for r in rows}.values())
+    added, updated = 0, 0
+    for chunk in chunks(rows, chunk_size):
+        existing = _existing_timestamps(session, base, counter, [r['timestamp'] for r in chunk], model)
+        records = [dict(r, time=datetime.fromtimestamp(r['timestamp'])) for r in chunk]
+        update_columns = [c for c in records[0] if c not in ('base', 'counter', 'timestamp')]
+        stmt = _upsert_statement(dialect, table, records, update_columns)
+        if stmt is not None:
+            session.execute(stmt)
+        else:
+            new = [r for r in records if r['timestamp'] not in existing]
+            old = [
+                dict({'_' + k: r[k] for k in ('base', 'counter', 'timestamp')}, **r)
+                for r in records if r['timestamp'] in existing
+            ]
+            if new:
+                session.execute(table.insert(), new)
+            if old:
+                stmt = table.update().where(and_(
+                    table.c.base == bindparam('_base'),
+                    table.c.counter == bindparam('_counter'),
+                    table.c.timestamp == bindparam('_timestamp')
+                ))
+                session.execute(stmt, old)
+        added += len(chunk) - len(existing)
+        updated += len(existing)
+    return added, updated
@@ -0,0 +1,117 @@
+import os
+import sys
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from butler.windows import COLUMNS, sliding_windows
+from settings import ensure_dir_exists
+
+
+def count_windows(count, past_length=72, future_length=12):
+    """Number of past-future windows cut out of `count` consecutive candlesticks"""
+    return max(count - past_length - future_length + 1, 0)
+
+
+def iter_windows(matrix, past_length=72, future_length=12, norm=True, chunk_size=10000):
+    """Generate the windows of a feature matrix `chunk_size` windows at a time, so that only a
+    chunk of the overlapping windows is ever materialized
+
+    :return: generator of past and future tensors
+    """
+    window_size = past_length + future_length
+    total = count_windows(len(matrix), past_length, future_length)
+    for start in range(0, total, chunk_size):
+        stop = min(start + chunk_size, total)
+        yield sliding_windows(matrix[start:stop + window_size - 1], past_length, future_length, norm)
+
+
+def split_masks(timestamps, splits, past_length=72, future_length=12):
+    """Tell which split each window of a series belongs to, a window belongs to a split when all
+    its candlesticks are within the split's time range
+
+    :param timestamps: timestamps of the candlesticks, in time order
+    :param splits: list of tuples of the split name, starting and ending timestamps (None for unbounded)
+    :return: dict of boolean masks over the windows keyed by split name
+    """
+    total = count_windows(len(timestamps), past_length, future_length)
+    first = timestamps[:total]
+    last = timestamps[past_length + future_length - 1:]
+    masks = {}
+    for suffix, start, end in splits:
+        mask = np.ones(total, dtype=bool)
+        if start is not None:
+            mask &= first >= start
+        if end is not None:
+            mask &= last <= end
+        masks[suffix] = mask
+    return masks
+
+
+class NpyWriter(object):
+    """Writes the past and future tensors of a dataset split into `x_{suffix}.npy` and
+    `y_{suffix}.npy`, pre-sized to the expected number of windows and filled through memory
+    maps chunk by chunk, so exports run in bounded memory. The files can be read back with
+    `np.load(path, mmap_mode='r')`
+    """
+    def __init__(self, path, suffix, size, past_length=72, future_length=12, dtype=np.float64):
+        """
+        :param path: directory of the files
+        :param suffix: name of the split, e.g. 'train'
+        :param size: number of windows the files will hold
+        :param past_length: number of candlesticks in the past part of a window
+        :param future_length: number of candlesticks in the future part of a window
+        :param dtype: data type stored in the files
+        """
+        self.allocate(path, suffix, size, past_length, future_length, dtype)
+        self.x_path, self.y_path = self.paths(path, suffix)
+        self.x = np.load(self.x_path, mmap_mode='r+')
+        self.y = np.load(self.y_path, mmap_mode='r+')
+        self.start = 0
+        self.size = size
+        self.offset = 0
+
+    @classmethod
+    def allocate(cls, path, suffix, size, past_length=72, future_length=12, dtype=np.float64):
+        """Create the files of a split sized for `size` windows, filled with zeros"""
+        ensure_dir_exists(path)
+        x_path, y_path = cls.paths(path, suffix)
+        print("Caching data of shape {}...".format((size, past_length, len(COLUMNS))))
+        open_memmap(x_path, mode='w+', dtype=dtype, shape=(size, past_length, len(COLUMNS))).flush()
+        open_memmap(y_path, mode='w+', dtype=dtype, shape=(size, future_length, len(COLUMNS))).flush()
+
+    @staticmethod
+    def paths(path, suffix):
+        return os.path.join(path, 'x_{}.npy'.format(suffix)), os.path.join(path, 'y_{}.npy'.format(suffix))
+
+    @classmethod
+    def region(cls, path, suffix, start, size):
+        """Open existing files for writing `size` windows from index `start`, so that several
+        processes can fill disjoint regions of the same files
+        """
+        writer = cls.__new__(cls)
+        writer.x_path, writer.y_path = cls.paths(path, suffix)
+        writer.x = np.load(writer.x_path, mmap_mode='r+')
+        writer.y = np.load(writer.y_path, mmap_mode='r+')
+        writer.start = start
+        writer.size = size
+        writer.offset = 0
+        return writer
+
+    def write(self, x, y):
+        """Append windows after the ones already written, windows beyond the size are dropped"""
+        count = min(len(x), self.size - self.offset)
+        if count < len(x):
+            sys.stderr.write("{} windows beyond the expected size dropped\n".format(len(x) - count))
+        begin = self.start + self.offset
+        self.x[begin:begin + count] = x[:count]
+        self.y[begin:begin + count] = y[:count]
+        self.offset += count
+
+    def close(self):
+        if self.offset < self.size:
+            sys.stderr.write("Only {} of {} windows written, the rest are zeros\n".format(self.offset, self.size))
+        if isinstance(self.x, np.memmap):
+            self.x.flush()
+            self.y.flush()
+        del self.x, self.y
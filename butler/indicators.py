@@ -3,21 +3,30 @@ import numpy as np
 
 def sma(array, n=5):
     """
-    Calculate the simple moving averages (SMA)
+    Calculate the simple moving averages (SMA), the first n - 1 values average over
+    all the values available so far. Computed from a cumulative sum in O(len(array))
 
     :param array: the price array represented in python list
     :param n: the average period
     :return: the corresponding SMA which has the same length of the input array
     """
-    ma = np.zeros(shape=(len(array), ))
-    for i, val in enumerate(array):
-        batch = array[max(i - n + 1, 0): i + 1]
-        # ma.append(np.mean(batch))
-        ma[i] = np.mean(batch)
-    return ma
+    array = np.asarray(array, dtype=np.float64)
+    total = np.cumsum(array)
+    total[n:] = total[n:] - total[:-n]
+    count = np.minimum(np.arange(1, len(array) + 1), n)
+    return total / count
+
+
+def _ema_block_weights(beta, size):
+    """Lower triangular matrix W[j, k] = beta ^ (j - k) that applies the EMA recurrence
+    to a whole block of values at once
+    """
+    lags = np.arange(size)
+    exponents = lags[:, None] - lags[None, :]
+    return np.where(exponents >= 0, beta ** np.maximum(exponents, 0), 0.)
 
 
-def ema(array, n=5):
+def ema(array, n=5, block_size=128, init=None):
     """
     Calculate the exponentially weighted averages (a.k.a. EMA) for a given array:
     v_t = beta * v_{t-1} + (1 - beta) * a_t
@@ -27,23 +36,53 @@ def ema(array, n=5):
     small numbers in the beginning, adding bias correction will solve this problem:
     v_t = v_t / (1 - beta ^ t)
 
+    The recurrence is evaluated block by block, each block being a single matrix product
+    seeded with the last value of the previous block
+
     :param array: the price array given in form of a python list of floating numbers
     :param n: the period considered
+    :param block_size: number of values resolved per matrix product
+    :param init: the EMA value preceding the array, to resume a previous calculation;
+        defaults to None, in which case the EMA starts at the first value
     :return: the EMA
     """
-    beta = 1 - 2 / (n + 1)
+    array = np.asarray(array, dtype=np.float64)
     ma = np.zeros(shape=(len(array),))
-    for i, val in enumerate(array):
-        if i == 0:
-            ma[i] = val
-            continue
-        previous = ma[i - 1]
-        current = beta * previous + (1 - beta) * val
-        ma[i] = current
+    if not len(array):
+        return ma
+    beta = 1 - 2 / (n + 1)
+    weights = _ema_block_weights(beta, block_size)
+    decay = beta ** np.arange(1, block_size + 1)
+    previous = array[0] if init is None else init
+    for start in range(0, len(array), block_size):
+        block = array[start:start + block_size]
+        size = len(block)
+        ma[start:start + size] = decay[:size] * previous + (1 - beta) * (weights[:size, :size] @ block)
+        previous = ma[start + size - 1]
     return ma
 
 
-def macd(array, a=12, b=26, c=9):
+def macd_components(array, a=12, b=26, c=9, init=None):
+    """
+    Calculates the three EMAs the MACD is built upon: the fast and slow EMAs of the
+    prices and the signal EMA of their difference
+
+    :param array: the price array represented as python list
+    :param a: fast period length
+    :param b: slow period length
+    :param c: the average period length of the MACD itself
+    :param init: tuple of the fast, slow and signal EMA values preceding the array,
+        to resume a previous calculation; defaults to None
+    :return: fast EMA, slow EMA, and signal
+    """
+    init = init or (None, None, None)
+    fast = ema(array, a, init=init[0])
+    slow = ema(array, b, init=init[1])
+    signal = ema(fast - slow, c, init=init[2])
+    return fast, slow, signal
+
+
+def macd(array, a=12, b=26, c=9, init=None):
     """
     Calculates the MACD, MACD signal, and their differences (histogram)
 
@@ -51,28 +90,37 @@ def macd(array, a=12, b=26, c=9):
     :param a: fast period length
     :param b: slow period length
     :param c: the average period length of the MACD itself
+    :param init: tuple of the fast, slow and signal EMA values preceding the array,
+        to resume a previous calculation; defaults to None
     :return: MACD, signal, and their difference
     """
-    fast = ema(array, a)
-    slow = ema(array, b)
+    fast, slow, signal = macd_components(array, a, b, c, init)
     proper = fast - slow
-    signal = ema(proper, c)
     diff = proper - signal
     return proper, signal, diff
 
 
-def moving_std(array, n=5):
+def moving_std(array, n=5, chunk_size=65536):
     """
-    Calculate the moving standard deviation with a given sliding window
+    Calculate the moving standard deviation with a given sliding window. Full windows are
+    reduced over a strided view of the array chunk by chunk, running sums of squares lose
+    too much precision on flat windows to match `np.std`
 
     :param array: the price array in python list to be calculated the stddev with
     :param n: sliding window size
+    :param chunk_size: number of windows reduced at a time
     :return: the corresponding std dev
     """
-    std = []
-    for i , val in enumerate(array):
-        batch = array[max(i - n + 1, 0): i + 1]
-        std.append(np.std(batch))
+    array = np.asarray(array, dtype=np.float64)
+    std = np.zeros(shape=(len(array), ))
+    for i in range(min(n - 1, len(array))):
+        std[i] = np.std(array[:i + 1])
+    if len(array) < n:
+        return std
+    windows = np.lib.stride_tricks.sliding_window_view(array, n)
+    for start in range(0, len(windows), chunk_size):
+        block = windows[start:start + chunk_size]
+        std[start + n - 1:start + n - 1 + len(block)] = block.std(axis=1)
     return std
 
 
@@ -85,10 +133,9 @@ def bbands(array, n=20, k=2):
     :param k: the ± standard deviation bound range
     :return: the band upper bound, lower bound, %b indicator, and bandwidth
     """
+    array = np.asarray(array, dtype=np.float64)
     ma = sma(array, n)
     std = moving_std(array, n)
-    ma = np.array(ma)
-    std = np.array(std)
 
     upper = ma + k * std
     lower = ma - k * std
@@ -98,6 +145,68 @@ def bbands(array, n=20, k=2):
     return upper, lower, percent_b, bandwidth
 
 
+def wilder(array, n=14):
+    """
+    Wilder's smoothing used by the RSI and ATR, i.e. an EMA with a smoothing factor of 1 / n,
+    which is the EMA of period 2n - 1
+
+    :param array: the values to smooth
+    :param n: the period considered
+    :return: the smoothed values
+    """
+    return ema(array, 2 * n - 1)
+
+
+def rsi(array, n=14):
+    """
+    Calculate the relative strength index, from 0 to 100, of a price array
+
+    :param array: the price array
+    :param n: the period considered
+    :return: the RSI which has the same length of the input array
+    """
+    array = np.asarray(array, dtype=np.float64)
+    delta = np.diff(array, prepend=array[:1])
+    gain = wilder(np.maximum(delta, 0), n)
+    loss = wilder(np.maximum(-delta, 0), n)
+    total = gain + loss
+    return np.divide(100 * gain, total, out=np.full(len(array), 50.), where=total > 0)
+
+
+def true_range(high, low, close):
+    """The greatest of the high-low range and the distances of the high and the low from the previous close"""
+    high, low, close = [np.asarray(a, dtype=np.float64) for a in (high, low, close)]
+    previous = np.concatenate([close[:1], close[:-1]])
+    return np.maximum(high - low, np.maximum(np.abs(high - previous), np.abs(low - previous)))
+
+
+def atr(high, low, close, n=14):
+    """
+    Calculate the average true range, the Wilder smoothed true range
+
+    :param high: the high price array
+    :param low: the low price array
+    :param close: the close price array
+    :param n: the period considered
+    :return: the ATR which has the same length of the input arrays
+    """
+    return wilder(true_range(high, low, close), n)
+
+
+def obv(close, volume):
+    """
+    Calculate the on-balance volume: the running total of the volume, added on rising closes
+    and subtracted on falling ones
+
+    :param close: the close price array
+    :param volume: the volume array
+    :return: the OBV, starting at 0
+    """
+    close = np.asarray(close, dtype=np.float64)
+    direction = np.sign(np.diff(close, prepend=close[:1]))
+    return np.cumsum(direction * np.asarray(volume, dtype=np.float64))
+
+
 # aliases
 ma = sma
 
@@ -0,0 +1,71 @@
+import numpy as np
+
+from butler.db import iter_pairs
+from candles import INDICATORS, OHLCV
+
+HOUR = 3600
+
+# columns an integrity scan reads, in this order
+SCAN_FIELDS = ('timestamp', ) + OHLCV + INDICATORS
+
+
+def runs(mask):
+    """Indices of the first and last items of every run of True values in a boolean array
+
+    :return: tuple of two int arrays
+    """
+    padded = np.concatenate([[False], mask, [False]])
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return edges[::2], edges[1::2] - 1
+
+
+def _spans(timestamps, mask):
+    first, last = runs(mask)
+    return [(int(timestamps[i]), int(timestamps[j])) for i, j in zip(first, last)]
+
+
+def scan_pair(base, counter, values):
+    """Check the candlesticks of a pair for every kind of problem at once
+
+    :param base: base coin
+    :param counter: counter coin
+    :param values: float array with the columns of `SCAN_FIELDS`, in time order
+    :return: the report of the pair, a dict of
+        - pair: the (base, counter) tuple
+        - count, first, last: number of candlesticks and first and last timestamps
+        - gaps: list of (first, last, hours) of every range of missing hours
+        - duplicates: timestamps found more than once
+        - irregular: list of (before, after) timestamps of consecutive candlesticks not a
+          whole number of hours apart
+        - zero_candles: list of (first, last) timestamps of the runs of all zero OHLCV values
+        - missing_indicators: list of (first, last) timestamps of the runs with an indicator missing
+        - ok: whether none of the above was found
+    """
+    timestamps = values[:, 0].astype(np.int64)
+    deltas = np.diff(timestamps)
+    gaps = np.flatnonzero((deltas > HOUR) & (deltas % HOUR == 0))
+    irregular = np.flatnonzero((deltas != 0) & (deltas % HOUR != 0) | (deltas < 0))
+    ohlcv = values[:, 1:1 + len(OHLCV)]
+    indicators = values[:, 1 + len(OHLCV):]
+
+    report = {
+        'pair': (base, counter),
+        'count': len(timestamps),
+        'first': int(timestamps[0]) if len(timestamps) else None,
+        'last': int(timestamps[-1]) if len(timestamps) else None,
+        'gaps': [
+            (int(timestamps[i]) + HOUR, int(timestamps[i + 1]) - HOUR, int(deltas[i]) // HOUR - 1)
+            for i in gaps
+        ],
+        'duplicates': np.unique(timestamps[1:][deltas == 0]).tolist(),
+        'irregular': [(int(timestamps[i]), int(timestamps[i + 1])) for i in irregular],
+        'zero_candles': _spans(timestamps, np.all(ohlcv == 0, axis=1)),
+        'missing_indicators': _spans(timestamps, np.any(np.isnan(indicators), axis=1)),
+    }
+    report['ok'] = not any(report[k] for k in ('gaps', 'duplicates', 'irregular', 'zero_candles', 'missing_indicators'))
+    return report
+
+
+def scan_database(session, batch_size=10000):
+    """Reports of every pair in the database, see `scan_pair`, from a single pass over the table"""
+    return [scan_pair(base, counter, values) for base, counter, values in iter_pairs(session, SCAN_FIELDS, batch_size=batch_size)]
@@ -0,0 +1,91 @@
+import numpy as np
+
+from butler.db import iter_pairs
+from butler.resample import TIMEFRAMES, bucket_starts
+
+
+class Panel(object):
+    """Candlesticks of several pairs aligned on a common time index, held in one contiguous
+    float32 array of shape (time, pair, field)
+    """
+    def __init__(self, values, timestamps, pairs, fields, observed):
+        """
+        :param values: float32 array of shape (len(timestamps), len(pairs), len(fields))
+        :param timestamps: int64 array of the time index
+        :param pairs: list of (base, counter) tuples, labels of the second axis
+        :param fields: list of field names, labels of the third axis
+        :param observed: boolean array of shape (len(timestamps), len(pairs)), False where a
+            pair has no candlestick and the values were filled
+        """
+        self.values = values
+        self.timestamps = timestamps
+        self.pairs = pairs
+        self.fields = fields
+        self.observed = observed
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def pair(self, base, counter):
+        """Values of a pair, of shape (time, field)"""
+        return self.values[:, self.pairs.index((base.upper(), counter.upper()))]
+
+    def field(self, name):
+        """Values of a field, of shape (time, pair)"""
+        return self.values[:, :, self.fields.index(name)]
+
+
+def _forward_fill(values, observed, fields):
+    """Carry the last observed values of each pair forward in place, except the volume of the
+    filled hours which is zero; values before the first observation stay missing
+    """
+    rows = np.arange(len(values))
+    for p in range(values.shape[1]):
+        if observed[:, p].all():
+            continue
+        index = np.maximum.accumulate(np.where(observed[:, p], rows, 0))
+        filled = ~observed[:, p] & observed[index, p]
+        values[filled, p] = values[index[filled], p]
+        if 'volume' in fields:
+            values[filled, p, fields.index('volume')] = 0
+
+
+def build_panel(session, pairs, fields, start, end, fill=None, timeframe='1h', model=None, batch_size=10000):
+    """Read several pairs with a single query and write each one straight into its slice of a
+    pre-allocated array, so that no per-pair DataFrame or intermediate copy is made
+
+    :param session: database session
+    :param pairs: list of (base, counter) tuples
+    :param fields: names of the columns to read
+    :param start: first timestamp of the time index
+    :param end: last timestamp of the time index
+    :param fill: how to fill the hours a pair has no candlestick for: None leaves NaN,
+        'ffill' carries the last values forward with zero volume, a number fills with it
+    :param timeframe: timeframe of the candlesticks, the step of the time index
+    :param model: candlestick model of the timeframe
+    :param batch_size: number of rows fetched at a time
+    :return: a `Panel`
+    """
+    fields = list(fields)
+    seconds, _ = TIMEFRAMES[timeframe]
+    first, last = bucket_starts([start, end], timeframe)
+    if first < start:
+        first += seconds
+    timestamps = np.arange(first, last + 1, seconds, dtype=np.int64)
+    values = np.full((len(timestamps), len(pairs), len(fields)), np.nan, dtype=np.float32)
+    observed = np.zeros((len(timestamps), len(pairs)), dtype=bool)
+
+    columns = {pair: i for i, pair in enumerate(pairs)}
+    for base, counter, rows in iter_pairs(session, ['timestamp'] + fields, pairs, start, end, batch_size, model):
+        p = columns[(base, counter)]
+        index = (rows[:, 0].astype(np.int64) - first) // seconds
+        aligned = (rows[:, 0].astype(np.int64) - first) % seconds == 0
+        values[index[aligned], p] = rows[aligned, 1:]
+        observed[index[aligned], p] = True
+
+    if fill == 'ffill':
+        _forward_fill(values, observed, fields)
+    elif fill is not None:
+        values[~observed] = fill
+    return Panel(values, timestamps, list(pairs), fields, observed)
@@ -0,0 +1,137 @@
+import inspect
+
+import numpy as np
+
+from butler.indicators import ema, moving_std, obv, rsi, sma, true_range, wilder
+
+# functions computing each kind of indicator and the suffixes of their outputs, see `indicator`
+KINDS = {}
+
+
+def indicator(kind, outputs=('', )):
+    """Register the function computing a kind of indicator. The function takes a `FusedPass`
+    and the parameters of the indicator, and returns one array per output
+
+    :param kind: name of the kind, e.g. 'sma'
+    :param outputs: suffixes of the names of the outputs, '' for a single unnamed one
+    """
+    def register(func):
+        KINDS[kind] = (func, outputs)
+        return func
+    return register
+
+
+def full_params(kind, params=None):
+    """Parameters of an indicator with the defaults of its function filled in, in the order of
+    its signature, so that the same indicator is always named the same way
+    """
+    if kind not in KINDS:
+        raise ValueError("Unknown indicator: {}, expected one of {}".format(kind, sorted(KINDS)))
+    params = dict(params or {})
+    signature = list(inspect.signature(KINDS[kind][0]).parameters.values())[1:]
+    full = {}
+    for p in signature:
+        if p.name in params:
+            full[p.name] = params.pop(p.name)
+        elif p.default is not inspect.Parameter.empty:
+            full[p.name] = p.default
+    if params:
+        raise ValueError("Unknown parameters of {}: {}".format(kind, sorted(params)))
+    return full
+
+
+def output_names(kind, params=None):
+    """Names under which the outputs of an indicator are stored, e.g. 'sma_24' or
+    'macd_12_26_9_signal', made of the kind, the parameter values and the output suffix
+    """
+    base = '_'.join([kind] + [str(v) for v in full_params(kind, params).values()])
+    return [base + ('_' + suffix if suffix else '') for suffix in KINDS[kind][1]]
+
+
+class FusedPass(object):
+    """A single pass over the OHLCV arrays of a pair computing several indicators, where the
+    moving averages and deviations several indicators are built upon are computed once
+    """
+    def __init__(self, columns):
+        """
+        :param columns: dict of float arrays keyed by field, at least the OHLCV fields
+        """
+        self.columns = {f: np.asarray(v, dtype=np.float64) for f, v in columns.items()}
+        self.memo = {}
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def _cached(self, key, func, *args):
+        if key not in self.memo:
+            self.memo[key] = func(*args)
+        return self.memo[key]
+
+    def sma(self, field, n):
+        return self._cached(('sma', field, n), sma, self[field], n)
+
+    def ema(self, field, n):
+        return self._cached(('ema', field, n), ema, self[field], n)
+
+    def std(self, field, n):
+        return self._cached(('std', field, n), moving_std, self[field], n)
+
+    def true_range(self):
+        return self._cached(('true_range', ), true_range, self['high'], self['low'], self['close'])
+
+
+@indicator('sma')
+def _sma(fused, n):
+    return [fused.sma('close', n)]
+
+
+@indicator('ema')
+def _ema(fused, n):
+    return [fused.ema('close', n)]
+
+
+@indicator('macd', outputs=('line', 'signal', 'hist'))
+def _macd(fused, a=12, b=26, c=9):
+    line = fused.ema('close', a) - fused.ema('close', b)
+    signal = ema(line, c)
+    return [line, signal, line - signal]
+
+
+@indicator('bbands', outputs=('pctb', 'width'))
+def _bbands(fused, n=20, k=2):
+    ma = fused.sma('close', n)
+    std = fused.std('close', n)
+    upper = ma + k * std
+    lower = ma - k * std
+    return [(fused['close'] - lower) / (upper - lower + 1e-10), (upper - lower) / ma]
+
+
+@indicator('rsi')
+def _rsi(fused, n=14):
+    return [rsi(fused['close'], n)]
+
+
+@indicator('atr')
+def _atr(fused, n=14):
+    return [wilder(fused.true_range(), n)]
+
+
+@indicator('obv')
+def _obv(fused):
+    return [obv(fused['close'], fused['volume'])]
+
+
+def compute(columns, specs):
+    """Compute several indicators of a pair in one pass
+
+    :param columns: dict of float arrays keyed by field, at least the OHLCV fields
+    :param specs: list of tuples of the kind and the dict of parameters of each indicator,
+        e.g. `settings.INDICATOR_SETTINGS['indicators']`
+    :return: dict of float arrays keyed by output name, see `output_names`
+    """
+    fused = FusedPass(columns)
+    results = {}
+    for kind, params in specs:
+        params = full_params(kind, params)
+        results.update(zip(output_names(kind, params), KINDS[kind][0](fused, **params)))
+    return results
@@ -0,0 +1,46 @@
+import numpy as np
+
+from candles import Candles
+
+# length in seconds and offset from the UNIX epoch of the candlesticks of each timeframe, the
+# epoch being a Thursday weeks are shifted by 4 days to start on Mondays
+TIMEFRAMES = {
+    '1h': (3600, 0),
+    '4h': (4 * 3600, 0),
+    '1d': (24 * 3600, 0),
+    '1w': (7 * 24 * 3600, 4 * 24 * 3600),
+}
+
+
+def bucket_starts(timestamps, timeframe):
+    """Opening timestamp of the candlestick of a timeframe each timestamp falls into"""
+    seconds, offset = TIMEFRAMES[timeframe]
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    return (timestamps - offset) // seconds * seconds + offset
+
+
+def resample(candles, timeframe):
+    """Roll hourly candlesticks up into the candlesticks of a longer timeframe: the first open,
+    highest high, lowest low, last close and total volume of the hours within each period
+
+    :param candles: hourly `Candles` in time order
+    :param timeframe: one of `TIMEFRAMES`
+    :return: tuple of the rolled up `Candles`, indicators left missing, and the number of hours
+        each of them is made of
+    """
+    timestamps = candles['timestamp']
+    if not len(timestamps):
+        return Candles.empty(candles.base, candles.counter), np.zeros(0, dtype=np.int64)
+    buckets = bucket_starts(timestamps, timeframe)
+    starts = np.flatnonzero(np.concatenate([[True], buckets[1:] != buckets[:-1]]))
+    ends = np.concatenate([starts[1:], [len(timestamps)]])
+    rolled = Candles.from_columns(
+        candles.base, candles.counter,
+        timestamp=buckets[starts],
+        open=candles['open'][starts],
+        close=candles['close'][ends - 1],
+        high=np.maximum.reduceat(candles['high'], starts),
+        low=np.minimum.reduceat(candles['low'], starts),
+        volume=np.add.reduceat(candles['volume'], starts)
+    )
+    return rolled, ends - starts
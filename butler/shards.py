@@ -0,0 +1,149 @@
+import json
+import os
+import re
+
+import numpy as np
+
+from butler.windows import COLUMNS
+from settings import ensure_dir_exists
+
+MANIFEST = 'manifest.json'
+
+
+def shard_name(split, base, counter, start):
+    """Name of the shard holding the windows of a pair from timestamp `start`, unique within a dataset"""
+    pair = re.sub(r'[^0-9A-Za-z]', '_', '{}-{}'.format(base, counter))
+    return '{}-{}-{}'.format(split, pair, int(start))
+
+
+def write_shard(path, split, base, counter, x, y, norm=True):
+    """Save the windows of a pair as a shard, one .npy file for the past and one for the future tensor
+
+    :param path: directory of the dataset
+    :param split: name of the split, e.g. 'train'
+    :param base: base coin
+    :param counter: counter coin
+    :param x: past tensor of shape (N, past_length, len(COLUMNS))
+    :param y: future tensor of shape (N, future_length, len(COLUMNS))
+    :param norm: whether the windows are normalized, recorded in the manifest
+    :return: the manifest entry of the shard
+    """
+    ts = COLUMNS.index('timestamp')
+    start = int(x[0, 0, ts])
+    name = shard_name(split, base, counter, start)
+    entry = {
+        'name': name,
+        'x': 'x_{}.npy'.format(name),
+        'y': 'y_{}.npy'.format(name),
+        'split': split,
+        'pair': [base, counter],
+        'size': len(x),
+        'start': start,
+        'end': int(y[-1, -1, ts]),
+        'past_length': x.shape[1],
+        'future_length': y.shape[1],
+        'normalization': 'window' if norm else None
+    }
+    ensure_dir_exists(path)
+    np.save(os.path.join(path, entry['x']), x)
+    np.save(os.path.join(path, entry['y']), y)
+    return entry
+
+
+class Manifest(object):
+    """The JSON index of a sharded dataset, listing every shard with its pair, split, time range,
+    window lengths and normalization. Shards of a dataset can be appended over time
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = os.path.join(path, MANIFEST)
+        self.shards = []
+        self.columns = list(COLUMNS)
+        if os.path.exists(self.file):
+            content = json.load(open(self.file, 'r'))
+            self.shards = content['shards']
+            self.columns = content['columns']
+
+    def last_end(self, base, counter, split):
+        """Timestamp at which the last window already exported for a pair and split ends, None
+        if nothing has been exported yet
+        """
+        ends = [
+            s['end'] for s in self.shards
+            if s['split'] == split and s['pair'] == [base, counter]
+        ]
+        return max(ends) if ends else None
+
+    def add(self, entries):
+        """Add shard entries, an entry replacing the one of the same name since its files were
+        overwritten, e.g. by a non-incremental rerun with more windows
+        """
+        entries = {e['name']: e for e in entries}
+        self.shards = [entries.pop(s['name'], s) for s in self.shards] + list(entries.values())
+
+    def save(self):
+        ensure_dir_exists(self.path)
+        content = {
+            'version': 1,
+            'columns': self.columns,
+            'shards': self.shards
+        }
+        tmp = self.file + '.tmp'
+        json.dump(content, open(tmp, 'w'), indent=2)
+        os.replace(tmp, self.file)
+
+
+class ShardedDataset(object):
+    """Reader of a sharded dataset, loading shards on demand so the whole dataset never has to
+    fit in memory. Windows are addressed by a global index across the shards of a split
+    """
+    def __init__(self, path, split=None, mmap_mode='r'):
+        """
+        :param path: directory of the dataset
+        :param split: only read the shards of this split, defaults to all
+        :param mmap_mode: how shards are loaded, see `np.load`; None reads them into memory
+        """
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self.manifest = Manifest(path)
+        self.shards = [s for s in self.manifest.shards if split is None or s['split'] == split]
+        self.offsets = np.cumsum([0] + [s['size'] for s in self.shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def shard(self, i):
+        """The past and future tensors of the i-th shard"""
+        entry = self.shards[i]
+        x = np.load(os.path.join(self.path, entry['x']), mmap_mode=self.mmap_mode)
+        y = np.load(os.path.join(self.path, entry['y']), mmap_mode=self.mmap_mode)
+        return x, y
+
+    def iter_shards(self):
+        for i in range(len(self.shards)):
+            yield self.shard(i)
+
+    def take(self, indices):
+        """Gather windows by global index, loading only the shards they belong to
+
+        :param indices: array of window indices
+        :return: past and future tensors of the windows, in the order of `indices`
+        """
+        indices = np.asarray(indices)
+        owners = np.searchsorted(self.offsets, indices, side='right') - 1
+        x, y = None, None
+        for i in np.unique(owners):
+            selected = np.nonzero(owners == i)[0]
+            shard_x, shard_y = self.shard(i)
+            local = indices[selected] - self.offsets[i]
+            if x is None:
+                x = np.empty((len(indices),) + shard_x.shape[1:], dtype=shard_x.dtype)
+                y = np.empty((len(indices),) + shard_y.shape[1:], dtype=shard_y.dtype)
+            x[selected] = shard_x[local]
+            y[selected] = shard_y[local]
+        return x, y
+
+    def sample(self, size, seed=None):
+        """Random windows drawn without replacement from the whole dataset"""
+        rng = np.random.default_rng(seed)
+        return self.take(rng.choice(len(self), size=size, replace=False))
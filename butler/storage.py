@@ -0,0 +1,184 @@
+import os
+from abc import ABC, abstractmethod
+
+import numpy as np
+from sqlalchemy import and_, bindparam, desc
+
+from butler.cache import CandleCache
+from butler.db import Candlestick, init_db, select_candlesticks, upsert_candlesticks
+from candles import Candles, FIELDS, OHLCV
+from settings import ROOT_DIR, DATABASE_SETTINGS
+
+
+class Storage(ABC):
+    """The operations every storage engine provides on the candlesticks of coin pairs, all of
+    them exchanging `Candles` so that engines can be swapped and benchmarked against each other.
+    An engine missing one of them cannot be instantiated
+    """
+    @abstractmethod
+    def save(self, candles):
+        """Insert or update candlesticks by timestamp, only their OHLCV values are written
+
+        :return: tuple of the numbers of added and updated candlesticks
+        """
+
+    @abstractmethod
+    def read(self, base, counter, start=None, end=None, fields=None):
+        """Candlesticks of a pair between two timestamps, in time order"""
+
+    @abstractmethod
+    def update(self, base, counter, timestamps, **columns):
+        """Overwrite columns, e.g. the indicators, of existing candlesticks by timestamp"""
+
+    @abstractmethod
+    def latest_timestamp(self, base, counter):
+        """Timestamp of the latest candlestick of a pair, None when it has none"""
+
+    @abstractmethod
+    def pairs(self):
+        """The (base, counter) tuples of the stored pairs"""
+
+
+class SqlStorage(Storage):
+    """Storage in a MySQL or SQLite database, see `butler.db.init_db`. Writes of a call are
+    batched in statements of `chunk_size` rows and committed once
+    """
+    def __init__(self, Session, chunk_size=1000):
+        self.Session = Session
+        self.chunk_size = chunk_size
+
+    def save(self, candles):
+        rows = candles[candles.valid()].to_records(OHLCV)
+        if not rows:
+            return 0, 0
+        session = self.Session()
+        try:
+            result = upsert_candlesticks(session, candles.base, candles.counter, rows, self.chunk_size)
+            session.commit()
+        finally:
+            session.close()
+        return result
+
+    def read(self, base, counter, start=None, end=None, fields=None):
+        fields = list(fields or FIELDS)
+        session = self.Session()
+        try:
+            values = select_candlesticks(session, base, counter, start, end, fields)
+        finally:
+            session.close()
+        return Candles.from_columns(base, counter, **{f: values[:, i] for i, f in enumerate(fields)})
+
+    def update(self, base, counter, timestamps, **columns):
+        table = Candlestick.__table__
+        stmt = table.update().where(and_(
+            table.c.base == base,
+            table.c.counter == counter,
+            table.c.timestamp == bindparam('_timestamp')
+        ))
+        names = list(columns)
+        values = [np.asarray(timestamps).tolist()] + [np.asarray(columns[n]).tolist() for n in names]
+        rows = [
+            dict(zip(names, [None if v != v else v for v in row[1:]]), _timestamp=row[0])
+            for row in zip(*values)
+        ]
+        session = self.Session()
+        try:
+            for i in range(0, len(rows), self.chunk_size):
+                session.execute(stmt, rows[i:i + self.chunk_size])
+            session.commit()
+        finally:
+            session.close()
+
+    def latest_timestamp(self, base, counter):
+        session = self.Session()
+        try:
+            latest = session.query(Candlestick.timestamp).filter(
+                Candlestick.base == base,
+                Candlestick.counter == counter
+            ).order_by(desc(Candlestick.timestamp)).first()
+        finally:
+            session.close()
+        return None if latest is None else latest[0]
+
+    def pairs(self):
+        session = self.Session()
+        try:
+            return [tuple(p) for p in session.query(Candlestick.base, Candlestick.counter).distinct().all()]
+        finally:
+            session.close()
+
+
+class FileStorage(Storage):
+    """Append-only storage in one raw binary file per column and pair, with the layout of
+    `CandleCache`. Hours newer than the stored ones are appended to the files and column
+    updates are written in place, while saving earlier hours rewrites the pair's files.
+    Ids are numbered per pair. Meant for a single writer process
+    """
+    def __init__(self, root):
+        """
+        :param root: directory of the files
+        """
+        self.files = CandleCache(root)
+
+    def save(self, candles):
+        base, counter = candles.base, candles.counter
+        candles = candles[candles.valid()]
+        if not len(candles):
+            return 0, 0
+        # sorted by timestamp, the last occurrence of a timestamp winning like upserts do
+        timestamps, index = np.unique(candles['timestamp'][::-1], return_index=True)
+        new = Candles.from_columns(base, counter, timestamp=timestamps, **{
+            f: candles[f][::-1][index] for f in OHLCV
+        })
+        meta = self.files.meta(base, counter)
+        if meta is None or meta['last'] is None or timestamps[0] > meta['last']:
+            count = 0 if meta is None else meta['count']
+            new.data['id'] = count + 1 + np.arange(len(new))
+            if meta is None:
+                self.files.store(new)
+            else:
+                self.files.append(new)
+            return len(new), 0
+
+        stored = self.files.load(base, counter)
+        existing = np.isin(timestamps, stored['timestamp'])
+        positions = np.searchsorted(stored['timestamp'], timestamps[existing])
+        for field in OHLCV:
+            stored.data[field][positions] = new[field][existing]
+        added = new[~existing]
+        added.data['id'] = stored['id'].max() + 1 + np.arange(len(added))
+        merged = Candles.concat([stored, added])
+        merged.data.sort(order='timestamp')
+        self.files.store(merged)
+        return len(added), int(existing.sum())
+
+    def read(self, base, counter, start=None, end=None, fields=None):
+        candles = self.files.load(base, counter, start, end, fields)
+        return Candles.empty(base, counter) if candles is None else candles
+
+    def update(self, base, counter, timestamps, **columns):
+        if not len(timestamps):
+            return
+        if self.files.positions(base, counter, timestamps) is None:
+            raise KeyError("Not all of the {}/{} timestamps are stored".format(base, counter))
+        self.files.update(base, counter, timestamps, **columns)
+
+    def latest_timestamp(self, base, counter):
+        meta = self.files.meta(base, counter)
+        return None if meta is None else meta['last']
+
+    def pairs(self):
+        return self.files.pairs()
+
+
+def open_storage(configs=None, chunk_size=1000):
+    """Open the storage engine selected by `configs['engine']`
+
+    :param configs: database settings in the format of `settings.DATABASE_SETTINGS`, the default
+    :param chunk_size: number of rows written per statement by the SQL engines
+    :return: a `Storage`
+    """
+    configs = dict(configs or DATABASE_SETTINGS)
+    if configs.get('engine') == 'file':
+        return FileStorage(configs.get('path') or os.path.join(ROOT_DIR, 'data', 'store'))
+    return SqlStorage(init_db(**configs), chunk_size)
@@ -0,0 +1,150 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from candles import FIELDS
+
+# columns of the training tensors, the same as `Butler.as_dataframe`
+COLUMNS = tuple(f for f in FIELDS if f != 'id')
+
+PRICE_COLUMNS = ('open', 'close', 'high', 'low', 'ma1', 'ma2', 'ma3')
+
+
+def feature_matrix(candles):
+    """Stack the columns of a `Candles` into a contiguous float array of shape (n, len(COLUMNS))"""
+    matrix = np.empty(shape=(len(candles), len(COLUMNS)))
+    for i, column in enumerate(COLUMNS):
+        matrix[:, i] = candles[column]
+    return matrix
+
+
+def _window_stats(windows, column):
+    """Mean and sample standard deviation of a column within every window, NaN values skipped
+    like pandas does. Each row is made contiguous first so the sums run in the same order as
+    pandas' reductions over a single window
+    """
+    values = np.ascontiguousarray(windows[:, :, COLUMNS.index(column)])
+    mean = np.nanmean(values, axis=1, keepdims=True)
+    std = np.nanstd(values, axis=1, ddof=1, keepdims=True)
+    return mean, std
+
+
+def normalize_windows(windows):
+    """Normalize every window in place the same way `Butler.normalize_pair` does: prices and
+    moving averages by the mean and standard deviation of the close price, volume by its own,
+    and the MACD line and signal by those of the MACD line, the histogram being recomputed
+    from the normalized line and signal
+
+    :param windows: float array of shape (number of windows, window length, len(COLUMNS))
+    :return: the same array
+    """
+    index = COLUMNS.index
+    mean, std = _window_stats(windows, 'close')
+    for column in PRICE_COLUMNS:
+        windows[:, :, index(column)] = (windows[:, :, index(column)] - mean) / (std + 1e-6)
+
+    mean, std = _window_stats(windows, 'volume')
+    windows[:, :, index('volume')] = (windows[:, :, index('volume')] - mean) / (std + 1e-6)
+
+    mean, std = _window_stats(windows, 'macd_proper')
+    for column in ('macd_proper', 'macd_signal'):
+        windows[:, :, index(column)] = (windows[:, :, index(column)] - mean) / (std + 1e-6)
+    windows[:, :, index('macd_diff')] = windows[:, :, index('macd_proper')] - windows[:, :, index('macd_signal')]
+    return windows
+
+
+def sliding_windows(matrix, past_length=72, future_length=12, norm=True):
+    """Cut every past-future window out of a feature matrix at once, using a strided view over
+    the matrix instead of slicing it window by window
+
+    :param matrix: float array of shape (n, len(COLUMNS)), see `feature_matrix`
+    :param past_length: number of candlesticks in the past part of a window
+    :param future_length: number of candlesticks in the future part of a window
+    :param norm: normalize each window, see `normalize_windows`
+    :return: past tensor of shape (N, past_length, F) and future tensor of shape (N, future_length, F)
+    """
+    window_size = past_length + future_length
+    if len(matrix) < window_size:
+        empty = np.zeros(shape=(0, window_size, matrix.shape[1]))
+        return empty[:, :past_length], empty[:, past_length:]
+    view = sliding_window_view(matrix, window_size, axis=0)
+    windows = np.ascontiguousarray(view.transpose(0, 2, 1))
+    if norm:
+        normalize_windows(windows)
+    return windows[:, :past_length], windows[:, past_length:]
+
+
+class WindowDataset(object):
+    """Past-future windows produced on demand from the candlesticks of several pairs. Each pair's
+    feature matrix is held once in a compact array and windows are gathered and normalized by
+    index when requested, instead of materializing every overlapping window beforehand
+
+    Timestamps are kept apart as integers, out of the feature array, and the windows are
+    normalized in double precision, so a float64 dataset gives the exact windows of
+    `sliding_windows`; with float32 only the produced windows are rounded, the timestamp column
+    included
+    """
+    def __init__(self, candles, past_length=72, future_length=12, norm=True, dtype=np.float32):
+        """
+        :param candles: list of `Candles`, one per pair
+        :param past_length: number of candlesticks in the past part of a window
+        :param future_length: number of candlesticks in the future part of a window
+        :param norm: normalize each window, see `normalize_windows`
+        :param dtype: data type of the stored features and of the windows produced
+        """
+        ts = COLUMNS.index('timestamp')
+        self.feature_columns = [i for i in range(len(COLUMNS)) if i != ts]
+        self.past_length = past_length
+        self.future_length = future_length
+        self.norm = norm
+        self.dtype = dtype
+        self.pairs = [(c.base, c.counter) for c in candles]
+        window_size = past_length + future_length
+        features = [np.zeros(shape=(0, len(COLUMNS) - 1), dtype=dtype)]
+        timestamps = [np.zeros(shape=(0, ), dtype=np.int64)]
+        starts = [np.zeros(shape=(0, ), dtype=np.int64)]
+        rows = 0
+        for c in candles:
+            features.append(feature_matrix(c)[:, self.feature_columns].astype(dtype))
+            timestamps.append(c['timestamp'].astype(np.int64))
+            starts.append(rows + np.arange(max(len(c) - window_size + 1, 0)))
+            rows += len(c)
+        self.features = np.concatenate(features)
+        self.timestamps = np.concatenate(timestamps)
+        self.starts = np.concatenate(starts)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        """The window at an index, or a batch of windows for a slice or an array of indices
+
+        :return: past and future tensors, of shape (past_length, F) and (future_length, F) for a
+            single window, with a leading batch dimension otherwise
+        """
+        single = np.ndim(index) == 0 and not isinstance(index, slice)
+        starts = self.starts[index]
+        rows = np.atleast_1d(starts)[:, None] + np.arange(self.past_length + self.future_length)
+        windows = np.empty(shape=rows.shape + (len(COLUMNS), ))
+        windows[:, :, self.feature_columns] = self.features[rows]
+        windows[:, :, COLUMNS.index('timestamp')] = self.timestamps[rows]
+        if self.norm:
+            normalize_windows(windows)
+        windows = windows.astype(self.dtype)
+        x, y = windows[:, :self.past_length], windows[:, self.past_length:]
+        return (x[0], y[0]) if single else (x, y)
+
+    def batches(self, batch_size=256, shuffle=True, seed=None, drop_last=False):
+        """Iterate over the windows once, i.e. one epoch, in batches
+
+        :param batch_size: number of windows per batch
+        :param shuffle: visit the windows in random order
+        :param seed: seed of the shuffling
+        :param drop_last: leave out the last batch when it is smaller than `batch_size`
+        :return: generator of past and future tensors
+        """
+        order = np.arange(len(self))
+        if shuffle:
+            np.random.default_rng(seed).shuffle(order)
+        stop = len(order) - len(order) % batch_size if drop_last else len(order)
+        for i in range(0, stop, batch_size):
+            yield self[order[i:i + batch_size]]
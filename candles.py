@@ -0,0 +1,107 @@
+import numpy as np
+from pandas import DataFrame
+
+# same order as the columns of the candlestick table
+FIELDS = (
+    'id', 'timestamp',
+    'open', 'close', 'high', 'low', 'volume',
+    'ma1', 'ma2', 'ma3', 'macd_proper', 'macd_signal', 'macd_diff'
+)
+OHLCV = ('open', 'close', 'high', 'low', 'volume')
+INDICATORS = ('ma1', 'ma2', 'ma3', 'macd_proper', 'macd_signal', 'macd_diff')
+
+DTYPE = np.dtype([('id', np.int64), ('timestamp', np.int64)] + [(f, np.float64) for f in OHLCV + INDICATORS])
+
+
+class Candles(object):
+    """Candlesticks of a single coin pair stored column by column in a NumPy structured array,
+    passed from the downloader to the butler and the indicators without building one Python
+    object per candlestick. Missing values are NaN, and a missing id is 0
+
+    Adapters to and from the list of dicts format and DataFrames are provided for the code
+    still working with them
+    """
+    def __init__(self, base, counter, data):
+        """
+        :param base: base coin
+        :param counter: counter coin
+        :param data: structured array of dtype `DTYPE`
+        """
+        self.base = base
+        self.counter = counter
+        self.data = data
+
+    @classmethod
+    def empty(cls, base, counter, size=0):
+        data = np.zeros(size, dtype=DTYPE)
+        for field in OHLCV + INDICATORS:
+            data[field] = np.nan
+        return cls(base, counter, data)
+
+    @classmethod
+    def from_columns(cls, base, counter, **columns):
+        """Build candlesticks from arrays of equal lengths keyed by field name, fields not
+        given are left missing
+        """
+        size = len(next(iter(columns.values()))) if columns else 0
+        candles = cls.empty(base, counter, size)
+        for field, values in columns.items():
+            candles.data[field] = values
+        return candles
+
+    @classmethod
+    def from_records(cls, records, base=None, counter=None):
+        """Build candlesticks from a list of dicts in the format of `Butler.save_candlesticks`
+        or `Butler.retrieve_candlesticks`, None values are treated as missing
+        """
+        if len(records):
+            base = base or records[0]['base']
+            counter = counter or records[0]['counter']
+        fields = [f for f in FIELDS if len(records) and f in records[0]]
+        columns = {
+            f: np.array([r[f] for r in records], dtype=DTYPE[f] if DTYPE[f] == np.int64 else np.float64)
+            for f in fields
+        }
+        return cls.from_columns(base, counter, **columns)
+
+    @classmethod
+    def from_dataframe(cls, df, base, counter):
+        return cls.from_columns(base, counter, **{f: df[f].values for f in FIELDS if f in df})
+
+    @classmethod
+    def concat(cls, candles):
+        return cls(candles[0].base, candles[0].counter, np.concatenate([c.data for c in candles]))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        """A column when given a field name, otherwise the selected candlesticks"""
+        if isinstance(key, str):
+            return self.data[key]
+        return Candles(self.base, self.counter, self.data[key])
+
+    def valid(self):
+        """Mask of the candlesticks not entirely made of zeros, see `Butler.valid_candlestick`"""
+        return np.any([self.data[f] != 0 for f in OHLCV], axis=0)
+
+    def to_records(self, fields=None):
+        """Convert to a list of dicts in the format `Butler.save_candlesticks` takes, missing
+        values become None
+
+        :param fields: fields to include besides base, counter and timestamp, defaults to all
+        :return: list of dicts
+        """
+        fields = ['timestamp'] + [f for f in (fields or FIELDS) if f != 'timestamp']
+        columns = [self.data[f].tolist() for f in fields]
+        records = []
+        for values in zip(*columns):
+            obj = {'base': self.base, 'counter': self.counter}
+            for field, value in zip(fields, values):
+                obj[field] = None if value != value else value
+            records.append(obj)
+        return records
+
+    def to_dataframe(self):
+        """Convert to a DataFrame with the same columns as `Butler.as_dataframe`"""
+        return DataFrame({f: self.data[f] for f in FIELDS if f != 'id'})
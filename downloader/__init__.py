@@ -1,15 +1,32 @@
 import settings
 from downloader.cccagg import CCCAGG
+from downloader.http_utils import set_rate_limit, configure_client
 
 DEFAULTS = {
-    'backend': 'CCCAGG'
+    'backend': 'CCCAGG',
+    'rate_limit': None,
+    'max_retries': 5,
+    'timeout': 10
 }
 
 configs = getattr(settings, 'DOWNLOADER_SETTINGS', None) or DEFAULTS
 
+set_rate_limit(configs.get('rate_limit'))
+configure_client(
+    max_retries=configs.get('max_retries', DEFAULTS['max_retries']),
+    timeout=configs.get('timeout', DEFAULTS['timeout'])
+)
+
 if configs['backend'] == 'CCCAGG':
     Downloader = CCCAGG
 # TODO: additional backends registered here if implemented
 else:
     print("Unknown backend: {}, fall back to default backend.".format(configs['backend']))
-    Downloader = CCCAGG
\ No newline at end of file
+    Downloader = CCCAGG
+
+# the asyncio downloader, whose methods are coroutines, is not interchangeable with `Downloader`;
+# None when aiohttp, needed by it alone, is not installed
+try:
+    from downloader.async_cccagg import AsyncCCCAGG as AsyncDownloader
+except ImportError:
+    AsyncDownloader = None
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime
+
+from candles import Candles
+from downloader.async_http_utils import AsyncHttpClient
+from downloader.cccagg import HOST, cache_dir, batch_windows, checked_batch, format_candlesticks, gap_requests, select_missing, stitch_batches
+from settings import ensure_dir_exists, DOWNLOADER_SETTINGS
+
+
+class AsyncCCCAGG(object):
+    """Asynchronous counterpart of `CCCAGG`, every download method is a coroutine and all of them
+    share one HTTP client, so that many pairs and exchanges can be downloaded from a single
+    event loop. Call `close` (or use the object as an async context manager) when done
+    """
+    def __init__(self, host=HOST, client=None):
+        """
+        :param host: the API host, overridden to test against a local server
+        :param client: the `AsyncHttpClient` to use, defaults to one configured from `DOWNLOADER_SETTINGS`
+        """
+        print("Using CCCAGG (async) as download source")
+        self.host = host
+        self.client = client or AsyncHttpClient(
+            max_retries=DOWNLOADER_SETTINGS.get('max_retries', 5),
+            timeout=DOWNLOADER_SETTINGS.get('timeout', 10),
+            rate_limit=DOWNLOADER_SETTINGS.get('rate_limit')
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.client.close()
+
+    async def _request(self, endpoint, params=None):
+        response = await self.client.get(self.host + endpoint, params)
+        if not response or 'Data' not in response:
+            sys.stderr.write("Invalid request...\n")
+            return None
+        return response['Data']
+
+    async def get_coin_list(self, from_cache=False):
+        cache_path = os.path.join(cache_dir, 'coins.json')
+        ensure_dir_exists(cache_dir)
+        if from_cache and os.path.exists(cache_path):
+            return json.load(open(cache_path, 'r'))
+        response = await self._request('/data/all/coinlist')
+        json.dump(response, open(cache_path, 'w'))
+        return response
+
+    async def get_exchanges(self, from_cache=False):
+        cache_path = os.path.join(cache_dir, 'exchanges.json')
+        ensure_dir_exists(cache_dir)
+        if from_cache and os.path.exists(cache_path):
+            return json.load(open(cache_path, 'r'))
+        response = await self.client.get(self.host + '/data/all/exchanges')
+        json.dump(response, open(cache_path, 'w'))
+        return response
+
+    async def get_top_coins(self, counter, limit=20):
+        print("Downloading top trading coins countered with {}...".format(counter))
+        params = {
+            'limit': limit,
+            'tsym': counter.upper()
+        }
+        response = await self._request('/data/top/totalvol', params) or []
+        coins = [c['ConversionInfo']['CurrencyFrom'] for c in response]
+        print("Download complete!\n")
+        return coins
+
+    async def _get_batch(self, base, counter, length, end, exchange):
+        params = {
+            'fsym': base.upper(),
+            'tsym': counter.upper(),
+            'limit': length,
+            'e': exchange,
+            'toTs': end
+        }
+        data = checked_batch(base, counter, end, await self._request('/data/histohour', params))
+        return data[:-1]
+
+    async def get_candlesticks(self, base, counter, start, end=None, exchange='CCCAGG', columnar=False):
+        """download the currency pair's OHLCV data between a given period, all the batches
+        are requested at the same time
+
+        :param base: base coin symbol
+        :param counter: counter coin symbol
+        :param start: starting timestamp
+        :param end: ending timestamp
+        :param exchange: the exchange from which the data is downloaded
+        :param columnar: return a `Candles` instead of a list of dicts
+        :return: data in a List
+        """
+        end = end or datetime.now().timestamp()
+        batches = batch_windows(start, end)
+        if not batches:
+            print("Data is recent, nothing to download.\n")
+            return Candles.empty(base, counter) if columnar else []
+        print("Downloading {}/{} candlesticks from {} to {}, {} data in total.".format(
+            base, counter,
+            datetime.fromtimestamp(start), datetime.fromtimestamp(end),
+            sum(length for length, _ in batches)
+        ))
+        results = await asyncio.gather(*[
+            self._get_batch(base, counter, length, ts, exchange) for length, ts in batches
+        ])
+        print("{} batches downloaded.".format(len(results)))
+        data = format_candlesticks(base, counter, stitch_batches(list(results)), columnar)
+        print("Download complete!\n")
+        return data
+
+    async def get_missing(self, base, counter, gaps, exchange='CCCAGG', columnar=False):
+        """download the candlesticks of given ranges of missing hours only, see `CCCAGG.get_missing`"""
+        batches = gap_requests(gaps)
+        if not batches:
+            return Candles.empty(base, counter) if columnar else []
+        print("Downloading {} missing {}/{} candlesticks in {} requests.".format(
+            sum(g[1] // 3600 - g[0] // 3600 + 1 for g in gaps), base, counter, len(batches)
+        ))
+        results = await asyncio.gather(*[
+            self._get_batch(base, counter, length, ts, exchange) for length, ts in batches
+        ])
+        buffer = [raw for batch in results for raw in batch]
+        data = format_candlesticks(base, counter, select_missing(buffer, gaps), columnar)
+        print("Download complete!\n")
+        return data
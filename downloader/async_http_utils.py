@@ -0,0 +1,123 @@
+import asyncio
+import random
+import sys
+from time import monotonic
+
+import aiohttp
+
+
+class AsyncTokenBucket(object):
+    """Token bucket shared by the coroutines of an event loop, the asyncio counterpart of
+    `http_utils.TokenBucket`
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: tokens refilled per second, None or 0 disables the limit
+        :param capacity: maximum number of tokens, i.e. the allowed burst, defaults to `rate`
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Take a token, waiting until one is available"""
+        if not self.rate:
+            return
+        async with self.lock:
+            while True:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttle(self, available):
+        """Cap the tokens at what the provider reports as still available in the current second"""
+        if self.rate:
+            self.tokens = min(self.tokens, max(available, 0))
+
+
+class AsyncHttpClient(object):
+    """Asynchronous HTTP client sharing one connection pool between all the requests of an event
+    loop, with the same retry policy as `http_utils.HttpClient`: exponential backoff with full
+    jitter, Retry-After on 429, no retries on other 4xx responses
+    """
+    def __init__(self, max_retries=5, timeout=10, backoff=1., max_backoff=60., pool_size=100, rate_limit=None):
+        """
+        :param max_retries: number of retries after the first attempt, negative to retry forever
+        :param timeout: seconds to wait for the server to respond
+        :param backoff: base delay in seconds before the first retry
+        :param max_backoff: maximum delay in seconds between two attempts
+        :param pool_size: maximum number of simultaneous connections
+        :param rate_limit: maximum number of requests per second, None for no limit
+        """
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.limiter = AsyncTokenBucket(rate_limit)
+        self.session = None
+
+    def _session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self.session
+
+    def _delay(self, attempt, retry_after=None):
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def _get(self, url, params):
+        """Send a single request
+
+        :return: tuple of the decoded response, None on failure, the Retry-After header
+            and whether to retry
+        """
+        await self.limiter.acquire()
+        try:
+            async with self._session().get(url, params=params) as response:
+                if response.status == 200:
+                    return await response.json(content_type=None), None, False
+                text = await response.text()
+                retry_after = response.headers.get('Retry-After')
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            sys.stderr.write("Error while sending request: {}\n".format(e))
+            return None, None, True
+        sys.stderr.write("Request failed with code {}, detail: {}\n".format(status, text))
+        if status == 429:
+            self.limiter.throttle(0)
+        return None, retry_after if status == 429 else None, status == 429 or status >= 500
+
+    async def get(self, url, params=None, max_retries=None):
+        """Send HTTP GET request repeatedly until it gets responses or the maximum number of retries exceeded
+
+        :param url: the URL to request
+        :param params: extra query parameters
+        :param max_retries: overrides the client's number of retries
+        :return: the decoded JSON response, None if all attempts failed
+        """
+        params = {k: str(v) for k, v in (params or {}).items()}
+        params['extraParams'] = 'CAPS'
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            result, retry_after, retry = await self._get(url, params)
+            if not retry or attempt == max_retries:
+                return result
+            await asyncio.sleep(self._delay(attempt, retry_after))
+            attempt += 1
+            sys.stderr.write("Retrying...\n")
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
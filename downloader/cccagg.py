@@ -1,18 +1,38 @@
 import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+import numpy as np
+
+from candles import Candles
 from downloader.http_utils import *
-from settings import ensure_dir_exists
+from settings import ensure_dir_exists, DOWNLOADER_SETTINGS
 
 HOST = "https://min-api.cryptocompare.com"
 
 cache_dir = os.path.dirname(__file__) + '/cache'
 
+# candlestick fields and the keys of the raw `/data/histohour` data they come from
+RAW_FIELDS = {
+    'timestamp': 'time',
+    'open': 'open',
+    'high': 'high',
+    'low': 'low',
+    'close': 'close',
+    'volume': 'volumeto'
+}
+
 
 class CCCAGG(object):
-    def __init__(self):
+    def __init__(self, max_workers=None):
+        """
+        :param max_workers: maximum number of batches of a pair downloaded at the same time,
+            defaults to `DOWNLOADER_SETTINGS['batch_concurrency']`
+        """
         print("Using CCCAGG as download source")
+        self.max_workers = max_workers or DOWNLOADER_SETTINGS.get('batch_concurrency', 4)
 
     def get_coin_list(self, from_cache=False):
         cache_file = 'coins.json'
@@ -34,6 +54,9 @@ class CCCAGG(object):
         json.dump(response, open(cache_path,'w'))
         return response
 
+    def sync_rate_limit(self):
+        return sync_rate_limit()
+
     def get_top_coins(self, counter, limit=20):
         print("Downloading top trading coins countered with {}...".format(counter))
         response = get_top_coins(counter, limit)
@@ -41,7 +64,7 @@ class CCCAGG(object):
         print("Download complete!\n")
         return coins
 
-    def get_candlesticks(self, base, counter, start, end=None, exchange='CCCAGG'):
+    def get_candlesticks(self, base, counter, start, end=None, exchange='CCCAGG', columnar=False):
         """download the currency pair's OHLCV data between a given period
 
         :param base: base coin symbol
@@ -49,55 +72,194 @@ class CCCAGG(object):
         :param start: starting timestamp
         :param end: ending timestamp
         :param exchange: the exchange from which the data is downloaded
+        :param columnar: return a `Candles` instead of a list of dicts
         :return: data in a List
         """
         end = end or datetime.now().timestamp()
-        delta = timedelta(seconds=end - start)
-        total_hours = int(delta.total_seconds() / 3600) - 1
-        batch_size = 2000
-        batch_end = datetime.fromtimestamp(start)
-        buffer = []
-        if not total_hours:
+        batches = batch_windows(start, end)
+        if not batches:
             print("Data is recent, nothing to download.\n")
-            return []
+            return Candles.empty(base, counter) if columnar else []
         print("Downloading {}/{} candlesticks from {} to {}, {} data in total.".format(
             base, counter,
             datetime.fromtimestamp(start), datetime.fromtimestamp(end),
-            total_hours
+            sum(length for length, _ in batches)
         ))
-        while total_hours > 0:
-            length = min(total_hours, batch_size)
-            batch_end += timedelta(hours=1) * length
-            ts = int(batch_end.timestamp())
-            data = get_candlesticks(base, counter, length, ts, exchange)
-            buffer += data
-            total_hours -= length
-            print("Progress: {} left".format(total_hours))
-        data = []
-        for raw in buffer:
-            obj = {
-                'base': base,
-                'counter': counter,
-                'timestamp': raw['time'],
-                'open': raw['open'],
-                'high': raw['high'],
-                'low': raw['low'],
-                'close': raw['close'],
-                'volume': raw['volumeto']
-            }
-            data.append(obj)
+
+        def download(batch):
+            length, ts = batch
+            return checked_batch(base, counter, ts, get_candlesticks(base, counter, length, ts, exchange))
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as pool:
+            results = list(pool.map(download, batches))
+        print("{} batches downloaded.".format(len(results)))
+        data = format_candlesticks(base, counter, stitch_batches(results), columnar)
         print("Download complete!\n")
         return data
 
+    def get_missing(self, base, counter, gaps, exchange='CCCAGG', columnar=False):
+        """download the candlesticks of given ranges of missing hours only, the ranges being
+        coalesced into as few requests as possible, downloaded at the same time
 
-def check_limit():
+        :param base: base coin symbol
+        :param counter: counter coin symbol
+        :param gaps: list of tuples starting with the first and last missing timestamps of a range
+        :param exchange: the exchange from which the data is downloaded
+        :param columnar: return a `Candles` instead of a list of dicts
+        :return: the candlesticks within the ranges
+        """
+        batches = gap_requests(gaps)
+        if not batches:
+            return Candles.empty(base, counter) if columnar else []
+        print("Downloading {} missing {}/{} candlesticks in {} requests.".format(
+            sum(g[1] // 3600 - g[0] // 3600 + 1 for g in gaps), base, counter, len(batches)
+        ))
+
+        def download(batch):
+            length, ts = batch
+            return checked_batch(base, counter, ts, get_candlesticks(base, counter, length, ts, exchange))
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as pool:
+            results = list(pool.map(download, batches))
+        buffer = [raw for batch in results for raw in batch]
+        data = format_candlesticks(base, counter, select_missing(buffer, gaps), columnar)
+        print("Download complete!\n")
+        return data
+
+
+def gap_requests(gaps, batch_size=2000):
+    """Coalesce ranges of missing hours into the fewest `/data/histohour` requests, each one
+    covering at most `batch_size` consecutive hours and possibly some existing hours in between
+
+    :param gaps: list of tuples starting with the first and last missing timestamps of a range,
+        e.g. the gaps of `butler.integrity.scan_pair`
+    :param batch_size: maximum number of candlesticks per request
+    :return: list of tuples of the number of candlesticks and the `toTs` of each request
+    """
+    windows = []
+    for gap in sorted(gaps):
+        start, last = gap[0], gap[1]
+        while start <= last:
+            if windows and start <= windows[-1][0] + (batch_size - 1) * 3600:
+                first = windows[-1][0]
+            else:
+                windows.append([start, start])
+                first = start
+            windows[-1][1] = min(last, first + (batch_size - 1) * 3600)
+            start = windows[-1][1] + 3600
+    return [((last - first) // 3600 + 1, last + 3600) for first, last in windows]
+
+
+def select_missing(buffer, gaps):
+    """Keep the raw candlesticks within the ranges of missing hours, in time order"""
+    if not buffer or not gaps:
+        return []
+    gaps = sorted(gaps)
+    firsts = np.array([g[0] for g in gaps])
+    lasts = np.array([g[1] for g in gaps])
+    buffer = sorted({raw['time']: raw for raw in buffer}.values(), key=lambda raw: raw['time'])
+    times = np.array([raw['time'] for raw in buffer])
+    owners = np.searchsorted(firsts, times, side='right') - 1
+    keep = (owners >= 0) & (times <= lasts[np.maximum(owners, 0)])
+    return [raw for raw, k in zip(buffer, keep) if k]
+
+
+def batch_windows(start, end, batch_size=2000):
+    """Split the hours between two timestamps into `/data/histohour` requests
+
+    :param start: starting timestamp
+    :param end: ending timestamp
+    :param batch_size: maximum number of candlesticks per request
+    :return: list of tuples of the number of candlesticks and the `toTs` of each request
+    """
+    delta = timedelta(seconds=end - start)
+    total_hours = int(delta.total_seconds() / 3600) - 1
+    batch_end = datetime.fromtimestamp(start)
+    batches = []
+    while total_hours > 0:
+        length = min(total_hours, batch_size)
+        batch_end += timedelta(hours=1) * length
+        batches.append((length, int(batch_end.timestamp())))
+        total_hours -= length
+    return batches
+
+
+def format_candlesticks(base, counter, buffer, columnar=False):
+    """Convert raw `/data/histohour` candlesticks into the format `Butler.save_candlesticks` takes,
+    either a list of dicts or a `Candles`
+    """
+    if columnar:
+        return Candles.from_columns(base, counter, **{
+            field: [raw[key] for raw in buffer] for field, key in RAW_FIELDS.items()
+        })
+    data = []
+    for raw in buffer:
+        obj = {'base': base, 'counter': counter}
+        for field, key in RAW_FIELDS.items():
+            obj[field] = raw[key]
+        data.append(obj)
+    return data
+
+
+def checked_batch(base, counter, end, batch):
+    """Pass a downloaded `/data/histohour` batch through, raising when its download failed so
+    that no candlesticks after the hole it would leave are saved
+
+    :raises RuntimeError: when the batch is not a list of candlesticks
+    """
+    if not isinstance(batch, list):
+        raise RuntimeError("Download of {}/{} candlesticks up to toTs={} failed: {}".format(
+            base.upper(), counter.upper(), end, batch
+        ))
+    return batch
+
+
+def stitch_batches(batches):
+    """Concatenate candlesticks batches in order, dropping candlesticks repeated at batch edges
+    and reporting gaps between consecutive candlesticks
+
+    :param batches: list of raw candlesticks batches in time order, see `checked_batch`
+    :return: raw candlesticks in a List
+    """
+    buffer = []
+    for batch in batches:
+        last = buffer[-1]['time'] if buffer else None
+        buffer.extend(raw for raw in batch if last is None or raw['time'] > last)
+    for previous, current in zip(buffer, buffer[1:]):
+        if current['time'] - previous['time'] != 3600:
+            sys.stderr.write("Gap detected between {} and {}\n".format(
+                datetime.fromtimestamp(previous['time']), datetime.fromtimestamp(current['time'])
+            ))
+    return buffer
+
+
+def rate_limit_stats():
     endpoint = '/stats/rate/limit'
     url = HOST + endpoint
-    results = http_get(url)
-    second = results.get('Second')
+    return http_get(url) or {}
+
+
+def check_limit():
+    second = rate_limit_stats().get('Second')
     return json.dumps(second, indent=2)
 
 
+def sync_rate_limit():
+    """Throttle the shared rate limiter to the number of calls the server reports as left
+    in the current second
+
+    :return: the number of calls left, None if unknown
+    """
+    results = rate_limit_stats()
+    if 'Second' in results:
+        calls_left = results['Second'].get('CallsLeft', {}).get('Histo')
+    else:
+        calls_left = results.get('Data', {}).get('calls_left', {}).get('second')
+    if calls_left is not None:
+        rate_limiter.throttle(calls_left)
+    return calls_left
+
+
 def get_coins():
     endpoint = "/data/all/coinlist"
     url = HOST + endpoint
@@ -134,8 +296,7 @@ def get_candlesticks(base, counter, length, end, exchange):
     }
     url = HOST + endpoint
     response = http_get(url, params)
-    if 'Data' not in response:
-        import sys
+    if not response or 'Data' not in response:
         sys.stderr.write("Invalid request...\n")
         return response
     data = response['Data']
@@ -151,8 +312,7 @@ def get_top_coins(counter, limit=20):
     }
     url = HOST + endpoint
     response = http_get(url, params)
-    if 'Data' not in response:
-        import sys
+    if not response or 'Data' not in response:
         sys.stderr.write("Invalid request...\n")
         return response
     data = response['Data']
@@ -1,39 +1,149 @@
+import random
 import sys
-from time import sleep
-from urllib.parse import urlencode
+import threading
+from time import sleep, monotonic
 
 import requests
+from requests.adapters import HTTPAdapter
 
 
-def _http_get(url, params=None):
-    params = params if params else {}
-    params['extraParams'] = 'CAPS'
-    encoded = urlencode(params)
-    try:
-        response = requests.get(url, encoded, timeout=10)
-    except BaseException as e:
-        sys.stderr.write("Error while sending request: {}\n".format(e))
-        return None
-    if response.status_code == 200:
-        return response.json()
-    sys.stderr.write("Request failed with code {}, detail: {}\n".format(response.status_code, response.text))
-    return None
+class TokenBucket(object):
+    """Thread-safe token bucket shared by every request sent to the data provider, so that
+    concurrent downloads together stay within the provider's per-second rate limit
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: tokens refilled per second, None or 0 disables the limit
+        :param capacity: maximum number of tokens, i.e. the allowed burst, defaults to `rate`
+        """
+        self.lock = threading.Lock()
+        self.configure(rate, capacity)
+
+    def configure(self, rate, capacity=None):
+        with self.lock:
+            self.rate = rate
+            self.capacity = capacity or rate
+            self.tokens = self.capacity
+            self.updated = monotonic()
+
+    def acquire(self):
+        """Take a token, blocking until one is available"""
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def throttle(self, available):
+        """Cap the tokens at what the provider reports as still available in the current second"""
+        if not self.rate:
+            return
+        with self.lock:
+            self.tokens = min(self.tokens, max(available, 0))
+
+
+rate_limiter = TokenBucket(None)
+
+
+def set_rate_limit(rate, capacity=None):
+    """Limit the requests sent by `http_get` to `rate` per second across all threads"""
+    rate_limiter.configure(rate, capacity)
+
+
+class HttpClient(object):
+    """HTTP client keeping connections to the data provider alive across requests. Failed
+    requests are retried with exponential backoff and full jitter, and 429 responses are
+    retried after the delay given by the provider's Retry-After header
+    """
+    def __init__(self, max_retries=5, timeout=10, backoff=1., max_backoff=60., pool_size=16):
+        """
+        :param max_retries: number of retries after the first attempt, negative to retry forever
+        :param timeout: seconds to wait for the server to respond
+        :param backoff: base delay in seconds before the first retry
+        :param max_backoff: maximum delay in seconds between two attempts
+        :param pool_size: number of connections kept alive per host
+        """
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _delay(self, attempt, response=None):
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                return float(retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _get(self, url, params):
+        """Send a single request
+
+        :return: tuple of the decoded response, None on failure, and whether to retry
+        """
+        rate_limiter.acquire()
+        try:
+            response = self.session.get(url, params=params, timeout=self.timeout)
+        except requests.RequestException as e:
+            sys.stderr.write("Error while sending request: {}\n".format(e))
+            return None, None, True
+        if response.status_code == 200:
+            try:
+                return response.json(), response, False
+            except ValueError as e:
+                sys.stderr.write("Invalid response: {}\n".format(e))
+                return None, response, True
+        sys.stderr.write("Request failed with code {}, detail: {}\n".format(response.status_code, response.text))
+        if response.status_code == 429:
+            rate_limiter.throttle(0)
+        return None, response, response.status_code == 429 or response.status_code >= 500
+
+    def get(self, url, params=None, max_retries=None):
+        """Send HTTP GET request repeatedly until it gets responses or the maximum number of retries exceeded
+
+        :param url: the URL to request
+        :param params: extra query parameters
+        :param max_retries: overrides the client's number of retries
+        :return: the decoded JSON response, None if all attempts failed
+        """
+        params = dict(params or {})
+        params['extraParams'] = 'CAPS'
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            result, response, retry = self._get(url, params)
+            if not retry or attempt == max_retries:
+                return result
+            sleep(self._delay(attempt, response))
+            attempt += 1
+            sys.stderr.write("Retrying...\n")
+
+
+client = HttpClient()
+
+
+def configure_client(**kwargs):
+    """Replace the client shared by `http_get`, see `HttpClient` for the options"""
+    global client
+    client = HttpClient(**kwargs)
+
 
-def http_get(url, params=None, retry_lim=-1):
-    """Send HTTP GET request repeatedly until it gets responses or the maximum number of retries exceeded
+def http_get(url, params=None, retry_lim=None):
+    """Send HTTP GET request through the shared client
 
     :param url: the URL to request
-    :param params: extra query parameters, will be URL encoded and multiple params will be concatenated with '&'
-    :param retry_lim: the maximum number of retry attempts
+    :param params: extra query parameters
+    :param retry_lim: the maximum number of retries, defaults to the client's
     :return: response
     """
-    trial = 0
-    response = None
-    while trial != retry_lim:
-        response = _http_get(url, params)
-        if response is not None:
-            break
-        trial += 1
-        sleep(1)
-        sys.stderr.write("Retrying...\n")
-    return response
\ No newline at end of file
+    return client.get(url, params, retry_lim)
@@ -4,8 +4,59 @@ ROOT_DIR = os.path.dirname(__file__)
 
 CACHE_ROOT = os.path.join(ROOT_DIR, 'cache')
 
+DATABASE_SETTINGS = {
+    # 'mysql', or 'sqlite' for a single database file needing no server; the Butler only runs
+    # on these, the append-only 'file' engine of `butler.storage` is for benchmark.py
+    'engine': 'mysql',
+    # MySQL server and credentials
+    'host': 'localhost',
+    'name': 'cccagg',
+    'user': 'root',
+    'pwd': 'root',
+    # database file of the sqlite engine, defaults to data/cccagg.sqlite under the project root
+    # (directory of the file engine in benchmarks, defaults to data/store)
+    'path': None
+}
+
+INDICATOR_SETTINGS = {
+    # indicators `Butler.compute_indicators` calculates and stores, as the kind registered in
+    # `butler.registry` and its parameters; adding one needs no change of the database schema
+    'indicators': [
+        ('sma', {'n': 6}),
+        ('sma', {'n': 12}),
+        ('sma', {'n': 24}),
+        ('ema', {'n': 12}),
+        ('ema', {'n': 26}),
+        ('macd', {'a': 12, 'b': 26, 'c': 9}),
+        ('bbands', {'n': 20, 'k': 2}),
+        ('rsi', {'n': 14}),
+        ('atr', {'n': 14}),
+        ('obv', {})
+    ]
+}
+
 DOWNLOADER_SETTINGS = {
-    'backend': 'CCCAGG'
+    # 'CCCAGG', the only blocking backend; the asyncio one is `downloader.AsyncDownloader`
+    'backend': 'CCCAGG',
+    # maximum number of requests per second sent to the data provider, shared by all threads
+    'rate_limit': 15,
+    # maximum number of 2000-hour batches of a single pair downloaded at the same time
+    'batch_concurrency': 4,
+    # number of retries of a failed request, with exponential backoff in between
+    'max_retries': 5,
+    # seconds to wait for the server to respond
+    'timeout': 10
+}
+
+COLLECTOR_SETTINGS = {
+    # number of coin pairs downloaded at the same time
+    'concurrency': 8,
+    # seconds `run_forever` waits after each hour closes before downloading the closed candlestick
+    'delay': 5,
+    # number of cycles whose latency stats `run_forever` keeps
+    'stats_history': 168,
+    # longer timeframes rolled up from the hourly candlesticks after they are saved
+    'timeframes': ('4h', '1d', '1w')
 }
 
 
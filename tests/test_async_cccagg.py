@@ -0,0 +1,126 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pytest
+
+from downloader.async_cccagg import AsyncCCCAGG
+from downloader.async_http_utils import AsyncHttpClient
+from downloader.cccagg import batch_windows
+
+HOUR = 3600
+START = 1514764800
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers like the CryptoCompare API: `/data/histohour` returns the `limit` + 1 hours up
+    to `toTs`, `/data/top/totalvol` a fixed list of coins
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.server.requests.append((url.path, params))
+        if url.path == '/data/histohour':
+            if int(params['toTs']) in self.server.failing:
+                self.send_error(500)
+                return
+            end = int(params['toTs']) // HOUR * HOUR
+            times = range(end - int(params['limit']) * HOUR, end + 1, HOUR)
+            data = [{
+                'time': t, 'open': t / HOUR, 'high': t / HOUR + 1, 'low': t / HOUR - 1,
+                'close': t / HOUR + .5, 'volumefrom': 1., 'volumeto': 2.
+            } for t in times]
+        elif url.path == '/data/top/totalvol':
+            data = [{'ConversionInfo': {'CurrencyFrom': coin}} for coin in ('BTC', 'ETH', 'XRP')]
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps({'Response': 'Success', 'Data': data}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.requests = []
+    # toTs of the /data/histohour requests answered with an error
+    server.failing = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run(server, method, *args, **kwargs):
+    async def main():
+        host = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        async with AsyncCCCAGG(host=host, client=AsyncHttpClient(max_retries=0, timeout=5)) as downloader:
+            return await getattr(downloader, method)(*args, **kwargs)
+    return asyncio.run(main())
+
+
+def test_get_candlesticks_paginates(server):
+    end = START + 4500 * HOUR
+    candles = run(server, 'get_candlesticks', 'eth', 'btc', START, end, columnar=True)
+    histohour = [params for path, params in server.requests if path == '/data/histohour']
+    assert len(histohour) == len(batch_windows(START, end)) > 1
+    assert all(params['fsym'] == 'ETH' and params['tsym'] == 'BTC' for params in histohour)
+    timestamps = candles['timestamp']
+    assert len(timestamps) == sum(length for length, _ in batch_windows(START, end))
+    assert np.all(np.diff(timestamps) == HOUR)
+    assert START <= timestamps[0] and timestamps[-1] < end
+    np.testing.assert_allclose(candles['close'], timestamps / HOUR + .5)
+    np.testing.assert_allclose(candles['volume'], 2.)
+
+
+def test_get_candlesticks_as_dicts(server):
+    data = run(server, 'get_candlesticks', 'eth', 'btc', START, START + 10 * HOUR)
+    assert [d['timestamp'] for d in data] == list(range(START, START + 9 * HOUR, HOUR))
+    assert all(d['base'] == 'eth' and d['counter'] == 'btc' for d in data)
+
+
+def test_get_top_coins(server):
+    assert run(server, 'get_top_coins', 'usdt', limit=3) == ['BTC', 'ETH', 'XRP']
+    assert server.requests[0][1]['tsym'] == 'USDT'
+
+
+def test_get_missing(server):
+    gaps = [
+        (START + 10 * HOUR, START + 14 * HOUR, 5),
+        (START + 100 * HOUR, START + 100 * HOUR, 1),
+        (START + 5000 * HOUR, START + 5002 * HOUR, 3),
+    ]
+    candles = run(server, 'get_missing', 'eth', 'btc', gaps, columnar=True)
+    expected = [t for first, last, _ in gaps for t in range(first, last + 1, HOUR)]
+    assert candles['timestamp'].tolist() == expected
+    assert len(server.requests) == 2
+
+
+def test_get_missing_without_gaps(server):
+    assert run(server, 'get_missing', 'eth', 'btc', []) == []
+    assert not server.requests
+
+
+def test_get_candlesticks_raises_on_failed_batch(server):
+    end = START + 4500 * HOUR
+    server.failing.add(batch_windows(START, end)[1][1])
+    with pytest.raises(RuntimeError, match='ETH/BTC'):
+        run(server, 'get_candlesticks', 'eth', 'btc', START, end, columnar=True)
+
+
+def test_get_missing_raises_on_failed_batch(server):
+    gaps = [(START + 10 * HOUR, START + 14 * HOUR, 5)]
+    server.failing.add(START + 15 * HOUR)
+    with pytest.raises(RuntimeError):
+        run(server, 'get_missing', 'eth', 'btc', gaps, columnar=True)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import downloader.cccagg as cccagg
+from downloader.cccagg import CCCAGG, batch_windows
+
+HOUR = 3600
+START = 1514764800
+
+
+@pytest.fixture
+def histohour(monkeypatch):
+    """Replace the `/data/histohour` request with a synthetic series, failing for the `toTs`
+    added to the returned set like `http_get` does once its retries are exhausted
+    """
+    failing = set()
+
+    def get_candlesticks(base, counter, length, end, exchange):
+        if end in failing:
+            return None
+        end = end // HOUR * HOUR
+        return [
+            {'time': t, 'open': 1., 'high': 1., 'low': 1., 'close': 1., 'volumeto': 1.}
+            for t in range(end - length * HOUR, end + 1, HOUR)
+        ][:-1]
+
+    monkeypatch.setattr(cccagg, 'get_candlesticks', get_candlesticks)
+    return failing
+
+
+def test_get_candlesticks(histohour):
+    end = START + 4500 * HOUR
+    candles = CCCAGG(max_workers=4).get_candlesticks('eth', 'btc', START, end, columnar=True)
+    assert np.all(np.diff(candles['timestamp']) == HOUR)
+
+
+def test_get_candlesticks_raises_on_failed_batch(histohour):
+    end = START + 4500 * HOUR
+    histohour.add(batch_windows(START, end)[1][1])
+    with pytest.raises(RuntimeError, match='ETH/BTC'):
+        CCCAGG(max_workers=4).get_candlesticks('eth', 'btc', START, end, columnar=True)
+
+
+def test_get_missing_raises_on_failed_batch(histohour):
+    histohour.add(START + 15 * HOUR)
+    with pytest.raises(RuntimeError):
+        CCCAGG().get_missing('eth', 'btc', [(START + 10 * HOUR, START + 14 * HOUR, 5)], columnar=True)
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+from butler.indicators import bbands, ema, macd, macd_components, moving_std, sma
+
+
+# the loop implementations the vectorized kernels replaced, kept as the reference
+def loop_sma(array, n=5):
+    ma = np.zeros(shape=(len(array), ))
+    for i, val in enumerate(array):
+        ma[i] = np.mean(array[max(i - n + 1, 0): i + 1])
+    return ma
+
+
+def loop_ema(array, n=5):
+    beta = 1 - 2 / (n + 1)
+    ma = np.zeros(shape=(len(array), ))
+    for i, val in enumerate(array):
+        ma[i] = val if i == 0 else beta * ma[i - 1] + (1 - beta) * val
+    return ma
+
+
+def loop_moving_std(array, n=5):
+    return np.array([np.std(array[max(i - n + 1, 0): i + 1]) for i in range(len(array))])
+
+
+def loop_macd(array, a=12, b=26, c=9):
+    proper = loop_ema(array, a) - loop_ema(array, b)
+    signal = loop_ema(proper, c)
+    return proper, signal, proper - signal
+
+
+def loop_bbands(array, n=20, k=2):
+    ma = loop_sma(array, n)
+    std = loop_moving_std(array, n)
+    upper = ma + k * std
+    lower = ma - k * std
+    return upper, lower, (array - lower) / (upper - lower + 1e-10), (upper - lower) / ma
+
+
+def prices(length, seed=0):
+    rng = np.random.default_rng(seed)
+    return 30000 + np.cumsum(rng.normal(0, 50, length))
+
+
+# 0, 1, shorter than the windows, around the EMA block size and long
+LENGTHS = [0, 1, 5, 19, 127, 128, 129, 1000]
+
+
+def assert_parity(actual, expected):
+    np.testing.assert_allclose(np.asarray(actual), np.asarray(expected), rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+@pytest.mark.parametrize('n', [1, 6, 24])
+def test_sma(length, n):
+    array = prices(length)
+    assert_parity(sma(array, n), loop_sma(array, n))
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+@pytest.mark.parametrize('n', [1, 12, 26])
+def test_ema(length, n):
+    array = prices(length)
+    assert_parity(ema(array, n), loop_ema(array, n))
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+@pytest.mark.parametrize('n', [1, 5, 20])
+def test_moving_std(length, n):
+    array = prices(length)
+    assert_parity(moving_std(array, n), loop_moving_std(array, n))
+
+
+def test_moving_std_flat_window():
+    array = np.concatenate([prices(50), np.full(50, 31234.5)])
+    assert_parity(moving_std(array, 20), loop_moving_std(array, 20))
+    assert np.all(moving_std(array, 20)[-30:] == 0)
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+def test_macd(length):
+    array = prices(length)
+    for actual, expected in zip(macd(array), loop_macd(array)):
+        assert_parity(actual, expected)
+
+
+@pytest.mark.parametrize('length', [1, 5, 19, 1000])
+def test_bbands(length):
+    array = prices(length)
+    for actual, expected in zip(bbands(array), loop_bbands(array)):
+        assert_parity(actual, expected)
+
+
+@pytest.mark.parametrize('split', [1, 100, 128, 999])
+def test_ema_resumes_from_state(split):
+    array = prices(1000)
+    head = ema(array[:split], 12)
+    assert_parity(ema(array[split:], 12, init=head[-1]), loop_ema(array, 12)[split:])
+
+
+@pytest.mark.parametrize('split', [1, 100, 999])
+def test_macd_resumes_from_state(split):
+    array = prices(1000)
+    fast, slow, signal = macd_components(array[:split])
+    resumed = macd(array[split:], init=(fast[-1], slow[-1], signal[-1]))
+    for actual, expected in zip(resumed, loop_macd(array)):
+        assert_parity(actual, expected[split:])